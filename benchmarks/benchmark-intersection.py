@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark the stages of scripts/intersection-snail.py on synthetic data
+
+Generates hazard rasters on several grids and CRSs, and synthetic point,
+line and polygon networks, then times each stage at each scale in a
+fresh process, recording features per second and peak resident memory.
+
+Run benchmarks, writing JSON results:
+
+    python benchmarks/benchmark-intersection.py --scales 1000 10000 100000 --output before.json
+
+Compare two sets of results:
+
+    python benchmarks/benchmark-intersection.py --compare before.json after.json
+"""
+import argparse
+import datetime
+import importlib.metadata
+import importlib.util
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import geopandas
+import numpy
+import pandas
+import rasterio
+import shapely
+
+from rasterio.transform import from_origin
+
+PIPELINE = os.path.join(os.path.dirname(__file__), "..", "scripts", "intersection-snail.py")
+
+# for instrumentation and the pipeline's imports of other modules in scripts/
+sys.path.insert(0, os.path.dirname(PIPELINE))
+import instrumentation  # noqa: E402
+
+# Synthetic hazard grids: key prefix, CRS, transform, height, width
+GRIDS = [
+    ("fine", "EPSG:4326", from_origin(89.0, 23.0, 0.01, 0.01), 200, 300),
+    # offset, so its cell edges do not coincide with the fine grid's
+    ("coarse", "EPSG:4326", from_origin(88.9875, 23.0125, 0.05, 0.05), 41, 61),
+    ("utm", "EPSG:32646", from_origin(180000, 2550000, 1000, 1000), 250, 250),
+]
+HAZARDS_PER_GRID = 3
+
+# Extent of synthetic features, within all grids
+EXTENT = (89.2, 21.2, 90.8, 22.8)
+
+STAGES = [
+    "nodes",
+    "edges_split",
+    "edges_associate",
+    "edges_join",
+    "areas_split",
+    "areas_associate",
+    "areas_coverage",
+]
+
+
+def main(args):
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    make_hazards(args.work_dir)
+    results = []
+    for n in args.scales:
+        for stage in args.stages:
+            logging.info("Running %s with %d features", stage, n)
+            result = run_in_process(stage, n, args.work_dir, args.options)
+            logging.info(
+                "  %.2fs, %.0f rows/s, peak RSS %s MB",
+                result['seconds'], result['features_per_second'], result['peak_rss_mb'])
+            results.append(result)
+
+    report = {'meta': metadata(), 'options': json.loads(args.options), 'results': results}
+    with open(args.output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    logging.info("Wrote %s", args.output)
+
+
+def run_in_process(stage, n, work_dir, options_json):
+    """Run one stage in a fresh process, so peak memory is for that stage alone"""
+    env = dict(os.environ, TQDM_DISABLE="1")
+    proc = subprocess.run(
+        [sys.executable, __file__, "--run", stage, str(n), "--work-dir", work_dir, "--options", options_json],
+        stdout=subprocess.PIPE, text=True, env=env, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def run_stage(stage, n, work_dir, options_json):
+    """Time one stage on n synthetic features"""
+    isnail = load_pipeline()
+    options = isnail.Options(**json.loads(options_json))
+    if options.read_mode == 'cube' and options.cube_dir is None:
+        options = options._replace(cube_dir=os.path.join(work_dir, "cubes"))
+    hazard_transforms, transforms = isnail.read_transforms(
+        pandas.read_csv(os.path.join(work_dir, "hazards.csv")), work_dir)
+    if options.read_mode == 'cube':
+        isnail.build_hazard_cubes(hazard_transforms, work_dir, options.cube_dir)
+
+    def split_edges(df):
+        splits = geopandas.GeoDataFrame({'parent': numpy.arange(len(df))}, geometry=df.geometry.values, crs=df.crs)
+        return isnail.split_on_transforms(
+            splits, transforms,
+            lambda df, t: isnail.split_df(df, t, options.split_processes, options.split_chunksize))
+
+    def split_areas(df):
+        splits = geopandas.GeoDataFrame({'parent': numpy.arange(len(df))}, geometry=df.geometry.values, crs=df.crs)
+        return isnail.split_on_transforms(splits, transforms, isnail.split_area_df)
+
+    def associate(splits):
+        isnail.associate_hazards(splits, hazard_transforms, work_dir, options.read_mode, options.cube_dir)
+        return splits
+
+    # set up inputs, untimed. rows is the number of rows the stage processes:
+    # features, or split pieces for stages after splitting
+    rng = numpy.random.default_rng(n)
+    rows = n
+    if stage == "nodes":
+        df = make_points(n, rng)
+        run = lambda: isnail.process_nodes(df, transforms, hazard_transforms, work_dir, options)
+    elif stage.startswith("edges"):
+        df = make_lines(n, rng)
+        if stage == "edges_split":
+            run = lambda: split_edges(df)
+        elif stage == "edges_associate":
+            splits = split_edges(df)
+            rows = len(splits)
+            run = lambda: associate(splits)
+        elif stage == "edges_join":
+            splits = associate(split_edges(df))
+            rows = len(splits)
+            run = lambda: isnail.join_attributes(df, splits)
+    elif stage.startswith("areas"):
+        df = make_polygons(n, rng)
+        if stage == "areas_split":
+            run = lambda: split_areas(df)
+        elif stage == "areas_associate":
+            splits = split_areas(df)
+            rows = len(splits)
+            run = lambda: associate(splits)
+        elif stage == "areas_coverage":
+            run = lambda: isnail.process_area_coverage(df, transforms, hazard_transforms, work_dir, options)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    setup_rss_mb = instrumentation.peak_rss_mb()
+    # peak memory of the stage alone, where the peak can be reset (Linux)
+    if instrumentation.reset_peak_rss():
+        peak_scope = 'stage'
+    else:
+        peak_scope = 'process' if setup_rss_mb is not None else 'unavailable'
+    start = time.perf_counter()
+    out = run()
+    seconds = time.perf_counter() - start
+    return {
+        'stage': stage,
+        'features': n,
+        'input_rows': rows,
+        'output_rows': len(out),
+        'seconds': seconds,
+        'features_per_second': rows / seconds,
+        'setup_rss_mb': setup_rss_mb,
+        'peak_rss_mb': instrumentation.peak_rss_mb(),
+        'peak_rss_scope': peak_scope,
+    }
+
+
+def load_pipeline():
+    """Import scripts/intersection-snail.py, which is not importable by name"""
+    spec = importlib.util.spec_from_file_location("intersection_snail", PIPELINE)
+    module = importlib.util.module_from_spec(spec)
+    # so worker processes can unpickle its functions, as with split_processes > 1
+    sys.modules["intersection_snail"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_hazards(work_dir):
+    """Write synthetic hazard rasters and hazards.csv, if not already there"""
+    hazards_csv = os.path.join(work_dir, "hazards.csv")
+    if os.path.exists(hazards_csv):
+        return
+    os.makedirs(work_dir, exist_ok=True)
+    rng = numpy.random.default_rng(0)
+    hazards = []
+    for name, crs, transform, height, width in GRIDS:
+        for i in range(HAZARDS_PER_GRID):
+            path = f"{name}_{i}.tif"
+            data = (rng.random((height, width)) * (i + 1)).astype('float32')
+            with rasterio.open(
+                    os.path.join(work_dir, path), 'w', driver='GTiff', height=height, width=width, count=1,
+                    dtype='float32', crs=crs, transform=transform, tiled=True, blockxsize=128,
+                    blockysize=128) as dataset:
+                dataset.write(data, 1)
+            hazards.append({'key': f"{name}_{i}", 'path': path})
+    pandas.DataFrame(hazards).to_csv(hazards_csv, index=False)
+
+
+def make_points(n, rng):
+    x, y = random_coordinates(n, rng)
+    return geopandas.GeoDataFrame(
+        {'id': numpy.arange(n)}, geometry=shapely.points(x, y), crs="EPSG:4326")
+
+
+def make_lines(n, rng, vertices=3, step=0.02):
+    """Random walks of a few vertices, a few grid cells long"""
+    x, y = random_coordinates(n, rng)
+    steps = rng.uniform(-step, step, (n, vertices - 1, 2))
+    coords = numpy.concatenate([numpy.stack([x, y], axis=1)[:, numpy.newaxis], steps], axis=1).cumsum(axis=1)
+    return geopandas.GeoDataFrame(
+        {'id': numpy.arange(n), 'value': rng.random(n)}, geometry=shapely.linestrings(coords), crs="EPSG:4326")
+
+
+def make_polygons(n, rng, max_size=0.04):
+    """Random boxes, up to a few grid cells across"""
+    x, y = random_coordinates(n, rng)
+    width, height = rng.uniform(0.002, max_size, (2, n))
+    return geopandas.GeoDataFrame(
+        {'id': numpy.arange(n)}, geometry=shapely.box(x, y, x + width, y + height), crs="EPSG:4326")
+
+
+def random_coordinates(n, rng):
+    minx, miny, maxx, maxy = EXTENT
+    return rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)
+
+
+def metadata():
+    """Describe the code and environment benchmarked"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(PIPELINE)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    packages = {}
+    for package in ("numpy", "pandas", "geopandas", "shapely", "rasterio", "nismod-snail"):
+        try:
+            packages[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            packages[package] = None
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'packages': packages,
+    }
+
+
+def compare(before_json, after_json, threshold=0.1):
+    """Print the change in time and peak memory per stage and scale
+
+    Flags stages more than threshold (as a fraction) slower, or using more
+    memory.
+    """
+    with open(before_json) as fh:
+        before = pandas.DataFrame(json.load(fh)['results'])
+    with open(after_json) as fh:
+        after = pandas.DataFrame(json.load(fh)['results'])
+    df = before.merge(after, on=['stage', 'features'], suffixes=('_before', '_after'))
+    df['time_ratio'] = df.seconds_after / df.seconds_before
+    # peak memory is null where it could not be read, giving no ratio
+    df['rss_ratio'] = pandas.to_numeric(df.peak_rss_mb_after) / pandas.to_numeric(df.peak_rss_mb_before)
+    df['regression'] = (df.time_ratio > 1 + threshold) | (df.rss_ratio > 1 + threshold)
+    columns = [
+        'stage', 'features', 'seconds_before', 'seconds_after', 'time_ratio',
+        'peak_rss_mb_before', 'peak_rss_mb_after', 'rss_ratio', 'regression']
+    with pandas.option_context('display.width', 200, 'display.max_rows', None):
+        print(df[columns].to_string(index=False, float_format=lambda v: f"{v:.3g}"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--scales", type=lambda s: int(float(s)), nargs="+", default=[1000, 10000, 100000],
+        help="numbers of features, up to 1e7")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument(
+        "--work-dir", default=os.path.join(tempfile.gettempdir(), "bgda-benchmark"),
+        help="directory for synthetic hazard rasters")
+    parser.add_argument("--options", default="{}", help="intersection-snail Options, as JSON")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    parser.add_argument("--run", nargs=2, metavar=("STAGE", "FEATURES"), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.run:
+        # run a single stage, called by run_in_process
+        stage, n = args.run
+        print(json.dumps(run_stage(stage, int(n), args.work_dir, args.options)))
+    else:
+        logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+        main(args)
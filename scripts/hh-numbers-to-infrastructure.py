@@ -2,15 +2,22 @@
 # coding: utf-8
 
 import os
-import pandas as pd
 import geopandas as gpd
 import dask.dataframe as dd
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.neighbors import BallTree
 
+import infra_access
+import instrumentation
+
 
 def infra_id_add(rural_PCA, urban_PCA, id_infra):
+    with instrumentation.stage('households per asset', layer=id_infra):
+        return _infra_id_add(rural_PCA, urban_PCA, id_infra)
+
+
+def _infra_id_add(rural_PCA, urban_PCA, id_infra):
     wealth_rural_columns = ['rural_wealthQ1','rural_wealthQ2','rural_wealthQ3','rural_wealthQ4','rural_wealthQ5']
     rural_infra = rural_PCA.groupby(['wealth_group',id_infra])['hid'].count().reset_index().compute().set_index([id_infra,'wealth_group']).unstack(level = 'wealth_group')
     rural_infra.columns = wealth_rural_columns
@@ -33,7 +40,9 @@ path_data_files = os.path.join(base_path,'incoming')
 
 ## education
 education_path = os.path.join(path_data_files,'critical_infra/bgd_poi_educationfacilities_lged/bgd_poi_educationfacilities_lged.shp')
-education = gpd.read_file(education_path, crs = 'EPSG:4326')
+with instrumentation.stage('read assets', layer='education') as record:
+    education = gpd.read_file(education_path, crs = 'EPSG:4326')
+    record['rows_out'] = len(education)
 #education = gpd.read_file(path_data_files+'bgd_poi_educationfacilities_lged/bgd_poi_educationfacilities_lged.shp', crs = 'EPSG:4326')
 education = education.to_crs('EPSG:4326')
 education['Lat']= education.geometry.y
@@ -42,7 +51,9 @@ education = education.reset_index().rename(columns = {'index':'id_edu'})
 
 ## hospital
 hospital_path = os.path.join(path_data_files, 'critical_infra/cegis_buildings/Hospitals/Hospitals.shp')
-hospital = gpd.read_file(hospital_path, crs = 'EPSG:4326')
+with instrumentation.stage('read assets', layer='hospital') as record:
+    hospital = gpd.read_file(hospital_path, crs = 'EPSG:4326')
+    record['rows_out'] = len(hospital)
 #health_facilities = gpd.read_file(path_data_files+'bgd_poi_healthfacilities_lged/bgd_poi_healthfacilities_lged.shp',crs = 'EPSG:3106')
 #hospital = health_facilities[health_facilities['FType']=='Hospital']
 hospital = hospital.to_crs('EPSG:4326')
@@ -52,7 +63,9 @@ hospital = hospital.reset_index(drop = True).reset_index().rename(columns  = {'i
 
 ### health facilities
 health_path = os.path.join(path_data_files, 'critical_infra/cegis_buildings/Health_facilities/Health_Facilities.shp')
-health = gpd.read_file(health_path, crs = 'EPSG:4326')
+with instrumentation.stage('read assets', layer='health') as record:
+    health = gpd.read_file(health_path, crs = 'EPSG:4326')
+    record['rows_out'] = len(health)
 #health = health_facilities[health_facilities['FType']!='Hospital']
 health = health.to_crs('EPSG:4326')
 health['Lat']= health.geometry.y
@@ -61,7 +74,9 @@ health = health.reset_index(drop = True).reset_index().rename(columns  = {'index
 
 ## shelters
 shelters_path = os.path.join(path_data_files,'critical_infra/Shelters/cyclone_shelters.shp')
-shelters = gpd.read_file(shelters_path)
+with instrumentation.stage('read assets', layer='shelters') as record:
+    shelters = gpd.read_file(shelters_path)
+    record['rows_out'] = len(shelters)
 #shelters = gpd.read_file(path_data_files+'Shelters/cyclone_shelters.shp')
 shelters =shelters.to_crs('EPSG:4326')
 shelters['Lat']= shelters.geometry.y
@@ -86,7 +101,9 @@ shelters = shelters.reset_index(drop = True).reset_index().rename(columns  = {'i
 ### growth centre
 #growth_centre = gpd.read_file(path_data_files+'Growth_centre/G_Centre_BTM.shp')
 growth_centre_path = os.path.join(path_data_files, 'critical_infra/Growth_centre_locations/G_Centre_BTM.shp')
-growth_centre = gpd.read_file(growth_centre_path)
+with instrumentation.stage('read assets', layer='growth_centre') as record:
+    growth_centre = gpd.read_file(growth_centre_path)
+    record['rows_out'] = len(growth_centre)
 growth_centre =growth_centre.to_crs('EPSG:4326')
 growth_centre['Lat']= growth_centre.geometry.y
 growth_centre['Long']= growth_centre.geometry.x
@@ -101,7 +118,9 @@ growth_centre= growth_centre.reset_index(drop = True).reset_index().rename(colum
 
 ### electricity substation
 elec_sub_path = os.path.join(path_data_files, 'energy/cegis_energy/Electricity/Existing_Sub_station.shp')
-elec_sub = gpd.read_file(elec_sub_path)
+with instrumentation.stage('read assets', layer='elec_sub') as record:
+    elec_sub = gpd.read_file(elec_sub_path)
+    record['rows_out'] = len(elec_sub)
 #elec_sub = gpd.read_file(path_data_files+'Electricity/SubStations.shp')
 elec_sub = elec_sub.to_crs('EPSG:4326')
 elec_sub['Lat']= elec_sub.geometry.y
@@ -110,7 +129,9 @@ elec_sub= elec_sub.reset_index(drop = True).reset_index().rename(columns  = {'in
 
 ## railway stations
 rail_station_path = os.path.join(path_data_files, 'transport/cegis_transport/Railway/Railway_Stations.shp')
-rail_station = gpd.read_file(rail_station_path)
+with instrumentation.stage('read assets', layer='rail_station') as record:
+    rail_station = gpd.read_file(rail_station_path)
+    record['rows_out'] = len(rail_station)
 rail_station = rail_station.to_crs('EPSG:4326')
 rail_station['Lat']= rail_station.geometry.y
 rail_station['Long']= rail_station.geometry.x
@@ -118,7 +139,9 @@ rail_station = rail_station.reset_index(drop = True).reset_index().rename(column
 
 ## road nodes
 road_node_path = os.path.join(path_data_files, 'transport/osm_road_corrected/osm_road_nodes_corrected.gpkg')
-road_node = gpd.read_file(road_node_path)
+with instrumentation.stage('read assets', layer='road_node') as record:
+    road_node = gpd.read_file(road_node_path)
+    record['rows_out'] = len(road_node)
 road_node = road_node.to_crs('EPSG:4326')
 road_node['Lat']= road_node.geometry.y
 road_node['Long']= road_node.geometry.x
@@ -137,29 +160,24 @@ urban_PCA = dd.read_csv(path_urban_PCA_data)
 list_district = ['Noakhali','Khulna','Barisal','Satkhira','Bhola','Bagerhat','Patuakhali','Barguna','Pirojpur','Jhalokati','Narail','Chittagong','Jessore', 'Chandpur','Coxs_Bazar','Lakshmipur','Feni','Shariatpur','Gopalganj']
 
 
-urban_data = pd.DataFrame()
-for district in list_district:
-    print('urban',district)
-    path_infra_access_urban = os.path.join(base_path, 'data/household_asset_analysis/Infra_access/urban_infra_access_'+str(district)+'.csv')
-    district_data = pd.read_csv(path_infra_access_urban, usecols=['hid','dist_health','dist_edu','dist_shelter','dist_hospital','dist_growth','dist_substation', 'dist_railstation', 'dist_roadnode', 'id_edu','id_health','id_shelter','id_hospital','id_growth','id_substation', 'id_railstation', 'id_roadnode'])
-    urban_data = pd.concat([urban_data, district_data], ignore_index = True, sort = False)
-    del district_data
+infra_access_columns = ['hid','dist_health','dist_edu','dist_shelter','dist_hospital','dist_growth','dist_substation', 'dist_railstation', 'dist_roadnode', 'id_edu','id_health','id_shelter','id_hospital','id_growth','id_substation', 'id_railstation', 'id_roadnode']
+path_infra_access = os.path.join(base_path, 'data/household_asset_analysis/infra_access.parquet')
 
+with instrumentation.stage('read infra access', settlement='urban') as record:
+    urban_data = infra_access.read_infra_access(path_infra_access, columns=infra_access_columns, districts=list_district, settlements=['urban'])
+    record['rows_out'] = len(urban_data)
 print(urban_data.columns)
 
-rural_data = pd.DataFrame()
-for district in list_district:
-    print('rural',district)
-    path_infra_access_rural = os.path.join(base_path, 'data/household_asset_analysis/Infra_access/rural_infra_access_'+str(district)+'.csv')
-    district_data = pd.read_csv(path_infra_access_rural, usecols=['hid','dist_health','dist_edu','dist_shelter','dist_hospital','dist_growth','dist_substation', 'dist_railstation', 'dist_roadnode', 'id_edu','id_health','id_shelter','id_hospital','id_growth','id_substation', 'id_railstation', 'id_roadnode'])
-    rural_data = pd.concat([rural_data, district_data], ignore_index = True, sort = False)
-    del district_data
+with instrumentation.stage('read infra access', settlement='rural') as record:
+    rural_data = infra_access.read_infra_access(path_infra_access, columns=infra_access_columns, districts=list_district, settlements=['rural'])
+    record['rows_out'] = len(rural_data)
 print(rural_data.columns)
 print('all link data loaded')
 
 # combining the PCA household data with the nearest neighbor household data
-rural_PCA = rural_PCA.merge(rural_data, on = 'hid')
-urban_PCA = urban_PCA.merge(urban_data, on = 'hid')
+with instrumentation.stage('merge households', rows_in=len(rural_data) + len(urban_data)):
+    rural_PCA = rural_PCA.merge(rural_data, on = 'hid')
+    urban_PCA = urban_PCA.merge(urban_data, on = 'hid')
 
 print('data merged')
 
@@ -184,7 +202,8 @@ rural_edu, urban_edu = infra_id_add(rural_PCA, urban_PCA, 'id_edu')
 edu_hh = rural_edu.merge(urban_edu, on = ['id_edu'], how = 'outer').replace(np.nan,0)
 edu_hh['households'] = edu_hh['rural_households'] + edu_hh['urban_households']
 path_edu_results = os.path.join(base_path, 'data/household_asset_analysis/assets_with_hh/education_households.gpkg')
-education.merge(edu_hh, on = ['id_edu']).to_file(path_edu_results, driver = 'GPKG', layer='nodes')
+with instrumentation.stage('write assets with households', rows_in=len(edu_hh), layer='id_edu'):
+    education.merge(edu_hh, on = ['id_edu']).to_file(path_edu_results, driver = 'GPKG', layer='nodes')
 print('education finished')
 
 ## cyclone shelter
@@ -192,7 +211,8 @@ rural_shelter, urban_shelter = infra_id_add(rural_PCA, urban_PCA, 'id_shelter')
 shelter_hh = rural_shelter.merge(urban_shelter, on = ['id_shelter'], how = 'outer').replace(np.nan,0)
 shelter_hh['households'] = shelter_hh['rural_households'] + shelter_hh['urban_households']
 path_shelters_results = os.path.join(base_path, 'data/household_asset_analysis/assets_with_hh/shelter_households.gpkg')
-shelters.merge(shelter_hh, on = ['id_shelter']).to_file(path_shelters_results, driver = 'GPKG', layer='nodes')
+with instrumentation.stage('write assets with households', rows_in=len(shelter_hh), layer='id_shelter'):
+    shelters.merge(shelter_hh, on = ['id_shelter']).to_file(path_shelters_results, driver = 'GPKG', layer='nodes')
 print('shelters finished')
 
 ## health centres
@@ -200,7 +220,8 @@ rural_health, urban_health = infra_id_add(rural_PCA, urban_PCA, 'id_health')
 health_hh = rural_health.merge(urban_health, on = ['id_health'], how = 'outer').replace(np.nan,0)
 health_hh['households'] = health_hh['rural_households'] + health_hh['urban_households']
 path_health_results = os.path.join(base_path, 'data/household_asset_analysis/assets_with_hh/health_households.gpkg')
-health.merge(health_hh, on = ['id_health']).to_file(path_health_results, driver = 'GPKG', layer='nodes')
+with instrumentation.stage('write assets with households', rows_in=len(health_hh), layer='id_health'):
+    health.merge(health_hh, on = ['id_health']).to_file(path_health_results, driver = 'GPKG', layer='nodes')
 print('health finished')
 
 ## hospital
@@ -208,7 +229,8 @@ rural_hospital, urban_hospital = infra_id_add(rural_PCA, urban_PCA, 'id_hospital
 hospital_hh = rural_hospital.merge(urban_hospital, on = ['id_hospital'], how = 'outer').replace(np.nan,0)
 hospital_hh['households'] = hospital_hh['rural_households'] + hospital_hh['urban_households']
 path_hospital_results = os.path.join(base_path, 'data/household_asset_analysis/assets_with_hh/hospital_households.gpkg')
-hospital.merge(hospital_hh, on = ['id_hospital']).to_file(path_hospital_results, driver = 'GPKG', layer='nodes')
+with instrumentation.stage('write assets with households', rows_in=len(hospital_hh), layer='id_hospital'):
+    hospital.merge(hospital_hh, on = ['id_hospital']).to_file(path_hospital_results, driver = 'GPKG', layer='nodes')
 print('hospital finished')
 
 ## growth centre
@@ -216,7 +238,8 @@ rural_growth, urban_growth = infra_id_add(rural_PCA, urban_PCA, 'id_growth')
 growth_hh = rural_growth.merge(urban_growth, on = ['id_growth'], how = 'outer').replace(np.nan,0)
 growth_hh['households'] = growth_hh['rural_households'] + growth_hh['urban_households']
 path_growth_results = os.path.join(base_path, 'data/household_asset_analysis/assets_with_hh/growth_centre_households.gpkg')
-growth_centre.merge(growth_hh, on = ['id_growth']).to_file(path_growth_results, driver = 'GPKG', layer='nodes')
+with instrumentation.stage('write assets with households', rows_in=len(growth_hh), layer='id_growth'):
+    growth_centre.merge(growth_hh, on = ['id_growth']).to_file(path_growth_results, driver = 'GPKG', layer='nodes')
 print('growth centre finished')
 
 ### electricity grid and substation
@@ -229,7 +252,8 @@ rural_substation, urban_substation = infra_id_add(rural_PCA[rural_PCA['electric_
 substation_hh = rural_substation.merge(urban_substation, on = ['id_substation'], how = 'outer').replace(np.nan,0)
 substation_hh['households'] = substation_hh['rural_households'] + substation_hh['urban_households']
 path_substation_results = os.path.join(base_path, 'data/household_asset_analysis/assets_with_hh/electricity_substation_households.gpkg')
-elec_sub.merge(substation_hh, on = ['id_substation']).to_file(path_substation_results, driver = 'GPKG', layer='nodes')
+with instrumentation.stage('write assets with households', rows_in=len(substation_hh), layer='id_substation'):
+    elec_sub.merge(substation_hh, on = ['id_substation']).to_file(path_substation_results, driver = 'GPKG', layer='nodes')
 print('electricity finished')
 
 
@@ -237,7 +261,8 @@ rural_railstation, urban_railstation = infra_id_add(rural_PCA, urban_PCA, 'id_ra
 railstation_hh = rural_railstation.merge(urban_railstation, on = ['id_railstation'], how = 'outer').replace(np.nan,0)
 railstation_hh['households'] = railstation_hh['rural_households'] + railstation_hh['urban_households']
 path_railstation_results = os.path.join(base_path, 'data/household_asset_analysis/assets_with_hh/railstation_households.gpkg')
-rail_station.merge(railstation_hh, on = ['id_railstation']).to_file(path_railstation_results, driver = 'GPKG', layer='nodes')
+with instrumentation.stage('write assets with households', rows_in=len(railstation_hh), layer='id_railstation'):
+    rail_station.merge(railstation_hh, on = ['id_railstation']).to_file(path_railstation_results, driver = 'GPKG', layer='nodes')
 print('railway stations finished')
 
 
@@ -245,5 +270,9 @@ rural_roadnode, urban_roadnode = infra_id_add(rural_PCA, urban_PCA, 'id_roadnode
 roadnode_hh = rural_roadnode.merge(urban_roadnode, on = ['id_roadnode'], how = 'outer').replace(np.nan,0)
 roadnode_hh['households'] = roadnode_hh['rural_households'] + roadnode_hh['urban_households']
 path_roadnode_results = os.path.join(base_path, 'data/household_asset_analysis/assets_with_hh/roadnode_households.gpkg')
-road_node.merge(roadnode_hh, on = ['id_roadnode']).to_file(path_roadnode_results, driver = 'GPKG', layer='nodes')
-print('roadnodes finished')
\ No newline at end of file
+with instrumentation.stage('write assets with households', rows_in=len(roadnode_hh), layer='id_roadnode'):
+    road_node.merge(roadnode_hh, on = ['id_roadnode']).to_file(path_roadnode_results, driver = 'GPKG', layer='nodes')
+print('roadnodes finished')
+
+instrumentation.write_report(instrumentation.report_fname(
+    'hh-numbers-to-infrastructure', os.path.join(base_path, 'data/household_asset_analysis/run_reports')))
@@ -0,0 +1,83 @@
+"""Read and write household infrastructure access, as a partitioned Parquet dataset
+
+The dataset has one partition per district and settlement type (urban or
+rural), written by infrastructure-services-nn.py:
+
+    infra_access.parquet/district=Khulna/settlement=urban/part-0.parquet
+
+Read selected columns, districts and settlement types in one call:
+
+    import infra_access
+
+    urban_data = infra_access.read_infra_access(
+        dataset_dir, columns=['hid', 'id_edu', 'dist_edu'], settlements=['urban'])
+"""
+import os
+
+import pandas
+import pyarrow
+import pyarrow.dataset
+
+
+PARTITIONING = pyarrow.dataset.partitioning(
+    pyarrow.schema([('district', pyarrow.string()), ('settlement', pyarrow.string())]),
+    flavor='hive',
+)
+
+
+def partition_fname(dataset_dir, district, settlement):
+    """File holding one district and settlement type"""
+    return os.path.join(dataset_dir, f"district={district}", f"settlement={settlement}", "part-0.parquet")
+
+
+def write_infra_access(df, dataset_dir, district, settlement):
+    """Write infrastructure access for one district and settlement type
+
+    Writes to a temporary file then moves it into place, so the partition
+    file exists only once complete. Readers skip the temporary file, as
+    its name starts with a dot.
+    """
+    fname = partition_fname(dataset_dir, district, settlement)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = os.path.join(os.path.dirname(fname), f".{os.path.basename(fname)}.{os.getpid()}.tmp")
+    downcast(df).to_parquet(tmp_fname, index=False, compression='zstd')
+    os.replace(tmp_fname, fname)
+
+
+def downcast(df):
+    """Compact column types: int32 ids and counts, float32 distances, int8 flags
+
+    Drops any geometry column, as the points are also in the latitude and
+    longitude columns.
+    """
+    df = pandas.DataFrame(df.drop(columns='geometry', errors='ignore'))
+    for column in df.columns:
+        if column.startswith('id_') or column.startswith('count_'):
+            df[column] = df[column].astype('int32')
+        elif column.startswith('dist_') or column.startswith('netdist_'):
+            df[column] = df[column].astype('float32')
+    if 'polder' in df.columns:
+        df['polder'] = df['polder'].astype('int8')
+    if 'Polder no.' in df.columns and df['Polder no.'].dtype == object:
+        # polder numbers, or 0 outside polders
+        df['Polder no.'] = df['Polder no.'].astype(str)
+    return df
+
+
+def read_infra_access(dataset_dir, columns=None, districts=None, settlements=None):
+    """Read infrastructure access for selected districts and settlement types
+
+    columns -> is a list of columns to read, default all (including the
+    district and settlement partition columns)
+    districts, settlements -> are lists of values to read, default all
+    """
+    dataset = pyarrow.dataset.dataset(dataset_dir, format='parquet', partitioning=PARTITIONING)
+    filters = []
+    if districts is not None:
+        filters.append(pyarrow.dataset.field('district').isin(list(districts)))
+    if settlements is not None:
+        filters.append(pyarrow.dataset.field('settlement').isin(list(settlements)))
+    filter_expression = None
+    for expression in filters:
+        filter_expression = expression if filter_expression is None else filter_expression & expression
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
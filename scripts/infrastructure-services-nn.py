@@ -1,56 +1,296 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import glob
+import hashlib
 import os
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import joblib
 import pandas as pd
 import geopandas as gpd
+import scipy.sparse
+import shapely
 import dask.dataframe as dd
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.sparse.csgraph import dijkstra
 from sklearn.neighbors import BallTree
-from math import radians, cos, sin, asin, sqrt
 
-def haversine(lon1, lat1, lon2, lat2):
+import infra_access
+import instrumentation
+
+EARTH_RADIUS_KM = 6371
+
+# Household columns used
+HOUSEHOLD_COLUMNS = ['hid','htype_class','Long','Lat','electric_class','water_class','toilet_class']
+
+ROAD_NODES_PATH = 'transport/osm_road_corrected/osm_road_nodes_corrected.gpkg'
+
+# Asset layers for nearest neighbours: name, point layer path, id column
+# the nearest asset id is its position in the layer
+ASSET_SOURCES = [
+    ('hospital', 'critical_infra/cegis_buildings/Hospitals/Hospitals.shp', 'id_hospital'),
+    ('health', 'critical_infra/cegis_buildings/Health_facilities/Health_Facilities.shp', 'id_health'),
+    ('edu', 'critical_infra/bgd_poi_educationfacilities_lged/bgd_poi_educationfacilities_lged.shp', 'id_edu'),
+    ('shelter', 'critical_infra/Shelters/cyclone_shelters.shp', 'id_shelter'),
+    ('embank', 'critical_infra/Embankments/embankment_points.gpkg', 'id_embank'),
+    ('growth', 'critical_infra/Growth_centre_locations/G_Centre_BTM.shp', 'id_growth'),
+    ('substation', 'energy/cegis_energy/Electricity/Existing_Sub_station.shp', 'id_substation'),
+    ('railstation', 'transport/cegis_transport/Railway/Railway_Stations.shp', 'id_railstation'),
+    ('roadnode', ROAD_NODES_PATH, 'id_roadnode'),
+]
+
+# Distances to the k nearest assets, for layers where the nearest may be
+# unavailable, such as a flooded hospital
+K_NEAREST = {'hospital': 3}
+
+# Radii (km) within which to count assets
+COUNT_RADII_KM = {'shelter': [2, 5, 10]}
+
+# Road network, for distances along roads: edges join from_node to to_node,
+# which are node_id values of ROAD_NODES_PATH, the 'roadnode' asset layer
+ROAD_EDGES_PATH = 'transport/osm_road_corrected/osm_road_edges_corrected.gpkg'
+# CRS in metres, for road lengths
+ROAD_LENGTH_CRS = 'EPSG:32646'
+# Asset layers for which to find distance along roads (netdist_<layer>)
+NETWORK_DISTANCE_LAYERS = ['hospital', 'health', 'edu', 'shelter', 'growth', 'railstation']
+
+
+def lat_lon_radians(df, point_columns):
+    """Long & lat columns as an array of (lat, lon) in radians, as the haversine metric expects"""
+    long_column, lat_column = point_columns
+    return np.radians(df[[lat_column, long_column]].to_numpy(dtype='float64'))
+
+
+def tree_leaf_size(n_points):
+    """BallTree leaf size for an asset layer
+
+    Haversine distances are expensive, so small leaves, which prune more
+    points per query, are fastest: 2 for layers of a few thousand points,
+    10 for larger layers such as road nodes.
     """
-    Calculate the great circle distance between two points
-    on the earth (specified in decimal degrees)
+    return 2 if n_points < 10000 else 10
+
+
+AssetLayer = namedtuple('AssetLayer', ['name', 'id_column', 'ids', 'tree'])
+
+
+def build_asset_layer(name, df, id_column):
+    """Build the tree for one asset layer, with Long & Lat columns
+
+    name -> is used for the distance column, dist_<name>
+    id_column -> is the asset id column, output for the nearest asset"""
+    tree = BallTree(lat_lon_radians(df, ['Long', 'Lat']), leaf_size=tree_leaf_size(len(df)), metric='haversine')
+    return AssetLayer(name, id_column, df[id_column].to_numpy(), tree)
+
+
+def load_asset_layer(name, path, id_column, index_dir, crs='EPSG:4326'):
+    """Load the tree for one asset point layer from the index store, building it if needed
+
+    Trees are saved in index_dir, keyed by a hash of the source file(s) and
+    the CRS, so each is built once. They are loaded memory-mapped, so
+    processes loading the same tree share one copy in memory.
     """
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    key = asset_index_key(path, crs)
+    fname = os.path.join(index_dir, f"{name}__{key}.joblib")
+    if not os.path.exists(fname):
+        with instrumentation.stage('build asset index', layer=name) as record:
+            df = gpd.read_file(path).to_crs(crs)
+            df['Lat'] = df.geometry.y
+            df['Long'] = df.geometry.x
+            df[id_column] = np.arange(len(df))
+            layer = build_asset_layer(name, df, id_column)
+            record['rows_out'] = len(df)
+        os.makedirs(index_dir, exist_ok=True)
+        # write then move, so that other processes never load a partial file
+        tmp_fname = f"{fname}.{os.getpid()}.tmp"
+        joblib.dump((layer.ids, layer.tree), tmp_fname)
+        os.replace(tmp_fname, fname)
+    with instrumentation.stage('load asset index', layer=name):
+        ids, tree = joblib.load(fname, mmap_mode='r')
+    return AssetLayer(name, id_column, ids, tree)
+
+
+def asset_index_key(path, crs):
+    """Hash of the contents of a data source, including any shapefile sidecar files, and a CRS"""
+    stem, ext = os.path.splitext(path)
+    fnames = sorted(glob.glob(glob.escape(stem) + '.*')) if ext.lower() == '.shp' else [path]
+    sha = hashlib.sha256(str(crs).encode())
+    for fname in fnames:
+        sha.update(os.path.basename(fname).encode())
+        with open(fname, 'rb') as fh:
+            for block in iter(lambda: fh.read(2**20), b''):
+                sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def nearest_assets(lat_lon, asset_layers, k_nearest=None, chunk_size=100000):
+    """Find the nearest assets in each layer to each point
+
+    lat_lon -> is an array of point (lat, lon) in radians
+    asset_layers -> is a list of AssetLayer
+    k_nearest -> is a dict of layer name to the number of nearest assets to find, default 1
+
+    Queries each layer's tree in chunks of points, so that temporary
+    arrays stay small. Returns a dict of layer name to an array of the
+    nearest asset ids (int32) and an array of great circle distances in km
+    to the k nearest assets (float32, one column per k, NaN where a layer
+    has fewer than k assets).
+    """
+    k_nearest = k_nearest or {}
+    nearest = {}
+    for layer in asset_layers:
+        k = k_nearest.get(layer.name, 1)
+        nearest[layer.name] = (
+            np.empty(len(lat_lon), dtype='int32'),
+            np.full((len(lat_lon), k), np.nan, dtype='float32'))
+    for start in range(0, len(lat_lon), chunk_size):
+        chunk = lat_lon[start:start + chunk_size]
+        for layer in asset_layers:
+            ids, distances = nearest[layer.name]
+            k = min(distances.shape[1], len(layer.ids))
+            distance, index = layer.tree.query(chunk, k=k)
+            ids[start:start + len(chunk)] = layer.ids[index[:, 0]]
+            # distances are in radians on the unit sphere
+            distances[start:start + len(chunk), :k] = distance * EARTH_RADIUS_KM
+    return nearest
+
+
+def count_assets_within(lat_lon, asset_layers, radii_km, chunk_size=100000):
+    """Count the assets within each radius of each point
+
+    lat_lon -> is an array of point (lat, lon) in radians
+    asset_layers -> is a list of AssetLayer
+    radii_km -> is a dict of layer name to a list of radii in km, for the layers to count
+
+    Only counts are found, never the lists of assets within each radius,
+    so memory use does not grow with the number of assets nearby. Returns
+    a dict of layer name to an array of counts (int32, one column per
+    radius).
+    """
+    layers = [layer for layer in asset_layers if layer.name in radii_km]
+    counts = {
+        layer.name: np.empty((len(lat_lon), len(radii_km[layer.name])), dtype='int32')
+        for layer in layers
+    }
+    for start in range(0, len(lat_lon), chunk_size):
+        chunk = lat_lon[start:start + chunk_size]
+        for layer in layers:
+            for i, radius_km in enumerate(radii_km[layer.name]):
+                counts[layer.name][start:start + len(chunk), i] = layer.tree.query_radius(
+                    chunk, r=radius_km / EARTH_RADIUS_KM, count_only=True)
+    return counts
+
+
+def read_road_graph(nodes_path, edges_path):
+    """Read the road network as a sparse graph of road lengths in km
+
+    Rows and columns are road nodes, in the order of the nodes file (so the
+    same as 'roadnode' asset ids), with one extra row and column for a
+    source node, unconnected, for use by road_node_distances.
+    """
+    with instrumentation.stage('read road graph') as record:
+        nodes = gpd.read_file(nodes_path, columns=['node_id'], ignore_geometry=True)
+        edges = gpd.read_file(edges_path, columns=['from_node', 'to_node'])
+        node_index = pd.Index(nodes['node_id'])
+        from_node = node_index.get_indexer(edges['from_node'])
+        to_node = node_index.get_indexer(edges['to_node'])
+        length_km = edges.geometry.to_crs(ROAD_LENGTH_CRS).length.to_numpy() / 1000
+        connected = (from_node >= 0) & (to_node >= 0)
+        # roads may be travelled in either direction
+        graph = sparse_graph(
+            np.concatenate([from_node[connected], to_node[connected]]),
+            np.concatenate([to_node[connected], from_node[connected]]),
+            np.concatenate([length_km[connected], length_km[connected]]),
+            len(nodes) + 1)
+        record['rows_out'] = graph.nnz
+    return graph
+
+
+def sparse_graph(from_node, to_node, weight, n_nodes):
+    """CSR graph of weighted edges, keeping the least weight of any duplicate edges
+
+    Explicit zero weights are kept as edges.
+    """
+    edges = pd.DataFrame({'from_node': from_node, 'to_node': to_node, 'weight': weight})
+    edges = edges.groupby(['from_node', 'to_node'], as_index=False)['weight'].min()
+    return scipy.sparse.csr_matrix(
+        (edges['weight'].to_numpy(), (edges['from_node'].to_numpy(), edges['to_node'].to_numpy())),
+        shape=(n_nodes, n_nodes))
+
+
+def road_node_distances(graph, road_layer, asset_layer):
+    """Distance (km) from each road node to the nearest asset, along roads
+
+    Each asset is joined to its nearest road node by the straight line
+    distance between them. A single Dijkstra search runs from a source
+    node joined to all of those road nodes, so finding the distances to
+    the nearest of all the assets at once. Nodes not connected to any
+    asset are NaN.
+    """
+    # the tree's data are the assets' (lat, lon) in radians
+    distance, road_node = road_layer.tree.query(np.asarray(asset_layer.tree.data), k=1)
+    source = graph.shape[0] - 1
+    source_edges = sparse_graph(
+        np.full(len(road_node), source), road_node[:, 0], distance[:, 0] * EARTH_RADIUS_KM, graph.shape[0])
+    # stack rather than add, as adding sparse matrices drops explicit zero weights
+    graph = scipy.sparse.vstack([graph[:-1], source_edges[-1:]], format='csr')
+    node_distances = dijkstra(graph, indices=source)[:-1]
+    node_distances[np.isinf(node_distances)] = np.nan
+    return node_distances.astype('float32')
+
+
+def load_road_distances(path_data_files, asset_layers, layers=NETWORK_DISTANCE_LAYERS):
+    """Distance along roads from each road node to the nearest asset, for each of layers"""
+    layers_by_name = {layer.name: layer for layer in asset_layers}
+    road_layer = layers_by_name['roadnode']
+    graph = read_road_graph(
+        os.path.join(path_data_files, ROAD_NODES_PATH), os.path.join(path_data_files, ROAD_EDGES_PATH))
+    road_distances = {}
+    for name in layers:
+        with instrumentation.stage('road distances', layer=name):
+            road_distances[name] = road_node_distances(graph, road_layer, layers_by_name[name])
+    return road_distances
 
-    # haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    r = 6371 # Radius of earth in kilometers. Use 3956 for miles
-    return c * r
 
+PolderIndex = namedtuple('PolderIndex', ['tree', 'polder_no'])
 
-def nearest_neighbour(df_input, df_merge, point_column_input, point_columns_merge):
+
+def build_polder_index(embankment):
+    """Build a tree of the polder boundaries, with prepared geometries for point-in-polygon tests"""
+    geoms = embankment.geometry.to_numpy()
+    shapely.prepare(geoms)
+    return PolderIndex(shapely.STRtree(geoms), embankment['Polder no.'].to_numpy())
+
+
+def polder_membership(points, polders):
+    """Index of the polder containing (or touching) each point, or -1 if none
+
+    points -> is an array of shapely points, in the CRS of the polders
+    polders -> is a PolderIndex
+
+    A point in more than one polder takes the first.
     """
-    df_input -> is the households
-    df_merge -> is the asset layer
-    point_column_input -> is the household point long & lat
-    point column_merge -> is the asset point long & lat"""
-
-    tree = BallTree(df_merge[point_columns_merge].values, leaf_size=2) #creates a tree with the asset points(df_merge)
-    # Query the BallTree on each feature
-    df_input['distance'], df_input['id_nearest'] = tree.query(
-        df_input[point_column_input].values, # The input array for the tree query for the households; 
-        k=1, # The number of nearest neighbors
-    )
-    df_merge = df_merge.reset_index().rename(columns  = {'index':'id_nearest'})
-    #offshore_loc.drop(,inplace = True)
-    df_input = df_input.merge(df_merge, on = 'id_nearest')
-    return df_input
-
-def run_accessibility(data):
+    point_index, polder_index = polders.tree.query(points, predicate='intersects')
+    no_polder = len(polders.polder_no)
+    index = np.full(len(points), no_polder)
+    np.minimum.at(index, point_index, polder_index)
+    index[index == no_polder] = -1
+    return index
+
+
+def run_accessibility(data, polders, asset_layers, k_nearest=K_NEAREST, radii_km=COUNT_RADII_KM, road_distances=None):
     """
     data (input) is either urban data or rural data (households)
-    first intersects with the polders
-    then goes through the asset categories and adds the id of the nearest asset using the nearest neighbor function
-    and then calculates the distance between the household and the asset using haversine
+    first finds the polder containing each household
+    then adds the id of and great circle distance to the nearest asset in each of the asset layers,
+    distances to the next nearest assets (dist_<layer>_2, ...) for layers in k_nearest
+    and counts of assets within each radius (count_<layer>_<radius>km) for layers in radii_km
+    road_distances (optional) is a dict of layer name to distance along roads from each road node to the nearest asset,
+    from load_road_distances, to add the distance to the nearest asset via the nearest road node (netdist_<layer>)
     """
     ## make geodataframe
     gdf = gpd.GeoDataFrame(data, geometry=gpd.points_from_xy(data.Long, data.Lat), crs = 'EPSG:3395')
@@ -59,216 +299,167 @@ def run_accessibility(data):
     gdf['longitude'] = gdf.geometry.x
 
     ### polder information
-    gdf_within_polder = gpd.overlay(gdf, embankment[['Polder no.','geometry']],how = 'intersection')
-    gdf_within_polder['polder'] = 1
-    gdf = gdf.merge(gdf_within_polder[['hid','polder','Polder no.']], on = 'hid', how = 'outer').replace(np.nan,0)
-
-    ### hospital
-    gdf = nearest_neighbour(gdf,hospital[['id_hospital','Lat','Long']].rename(columns = {'Lat':'Lat_hospital','Long':'Long_hospital'}),['longitude','latitude'],['Long_hospital','Lat_hospital']).drop(columns = ['id_nearest'])
-    gdf['dist_hospital'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_hospital'],row['Lat_hospital']), axis=1)
-
-    ### health
-    gdf = nearest_neighbour(gdf,health[['id_health','Lat','Long']].rename(columns = {'Lat':'Lat_health','Long':'Long_health'}),['longitude','latitude'],['Long_health','Lat_health']).drop(columns = ['id_nearest'])
-    gdf['dist_health'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_health'],row['Lat_health']), axis=1)
-
-    ### education
-    gdf = nearest_neighbour(gdf,education[['id_edu','Lat','Long']].rename(columns = {'Lat':'Lat_edu','Long':'Long_edu'}),['longitude','latitude'],['Long_edu','Lat_edu']).drop(columns = ['id_nearest'])
-    gdf['dist_edu'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_edu'],row['Lat_edu']), axis=1)
-
-    ### shelters
-    gdf = nearest_neighbour(gdf,shelters[['id_shelter','Lat','Long']].rename(columns = {'Lat':'Lat_shel','Long':'Long_shel'}),['longitude','latitude'],['Long_shel','Lat_shel']).drop(columns = ['id_nearest'])
-    gdf['dist_shelter'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_shel'],row['Lat_shel']), axis=1)
-    
-    ### road
-    #gdf = nearest_neighbour(gdf,road[['id_road','Lat','Long']].rename(columns = {'Lat':'Lat_road','Long':'Long_road'}),['longitude','latitude'],['Long_road','Lat_road']).drop(columns = ['id_nearest'])
-    #gdf['dist_road'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_road'],row['Lat_road']), axis=1)
-
-    ### road rural
-    #gdf = nearest_neighbour(gdf,road_rural[['id_road_rural','Lat','Long']].rename(columns = {'Lat':'Lat_road_rural','Long':'Long_road_rural'}),['longitude','latitude'],['Long_road_rural','Lat_road_rural']).drop(columns = ['id_nearest'])
-    #gdf['dist_road_rural'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_road_rural'],row['Lat_road_rural']), axis=1)
-
-    ### embankment
-    gdf = nearest_neighbour(gdf,embankment_point[['id_embank','Lat','Long']].rename(columns = {'Lat':'Lat_embank','Long':'Long_embank'}),['longitude','latitude'],['Long_embank','Lat_embank']).drop(columns = ['id_nearest'])
-    gdf['dist_embank'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_embank'],row['Lat_embank']), axis=1)
-
-    ### cities
-    #gdf = nearest_neighbour(gdf,cities[['id_urban','Lat','Long']].rename(columns = {'Lat':'Lat_urban','Long':'Long_urban'}),['longitude','latitude'],['Long_urban','Lat_urban']).drop(columns = ['id_nearest'])
-    #gdf['dist_urban'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_urban'],row['Lat_urban']), axis=1)
-
-    ### coast
-    #gdf = nearest_neighbour(gdf,coast[['Lat','Long']].rename(columns = {'Lat':'Lat_coast','Long':'Long_coast'}),['longitude','latitude'],['Long_coast','Lat_coast']).drop(columns = ['id_nearest'])
-    #gdf['dist_coast'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_coast'],row['Lat_coast']), axis=1)
-    #gdf = gdf.drop(columns = ['Lat_coast','Long_coast'])
-
-    ### growth_centre
-    gdf = nearest_neighbour(gdf,growth_centre[['id_growth','Lat','Long']].rename(columns = {'Lat':'Lat_growth','Long':'Long_growth'}),['longitude','latitude'],['Long_growth','Lat_growth']).drop(columns = ['id_nearest'])
-    gdf['dist_growth'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_growth'],row['Lat_growth']), axis=1)
-
-    ### electricity grid
-    #gdf = nearest_neighbour(gdf,elec_grid[['id_grid','Lat','Long']].rename(columns = {'Lat':'Lat_grid','Long':'Long_grid'}),['longitude','latitude'],['Long_grid','Lat_grid']).drop(columns = ['id_nearest'])
-    #gdf['dist_grid'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_grid'],row['Lat_grid']), axis=1)
-
-    ### electricity grid
-    gdf = nearest_neighbour(gdf,elec_sub[['id_substation','Lat','Long']].rename(columns = {'Lat':'Lat_substation','Long':'Long_substation'}),['longitude','latitude'],['Long_substation','Lat_substation']).drop(columns = ['id_nearest'])
-    gdf['dist_substation'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_substation'],row['Lat_substation']), axis=1)
-
-    ### railway stations
-    gdf = nearest_neighbour(gdf, rail_station[['id_railstation','Lat','Long']].rename(columns = {'Lat':'Lat_railstation','Long':'Long_railstation'}),['longitude','latitude'],['Long_railstation','Lat_railstation']).drop(columns = ['id_nearest'])
-    gdf['dist_railstation'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_railstation'],row['Lat_railstation']), axis=1)
-
-    ### road nodes
-    gdf = nearest_neighbour(gdf, road_node[['id_roadnode','Lat','Long']].rename(columns = {'Lat':'Lat_roadnode','Long':'Long_roadnode'}),['longitude','latitude'],['Long_roadnode','Lat_roadnode']).drop(columns = ['id_nearest'])
-    gdf['dist_roadnode'] = gdf.apply(lambda row: haversine(row['longitude'], row['latitude'],row['Long_roadnode'],row['Lat_roadnode']), axis=1)
-
-    return gdf
-
-
-#### merge various spatial data
-#path_data_files = 'Input_data/' #jaspers code
-
-base_path = os.path.join('D:/Bangladesh')
-path_data_files = os.path.join(base_path,'incoming')
-    
-## education
-education_path = os.path.join(path_data_files,'critical_infra/bgd_poi_educationfacilities_lged/bgd_poi_educationfacilities_lged.shp')
-education = gpd.read_file(education_path, crs = 'EPSG:4326')
-#education = gpd.read_file(path_data_files,'critical_infra/bgd_poi_educationfacilities_lged/bgd_poi_educationfacilities_lged.shp', crs = 'EPSG:4326')
-education = education.to_crs('EPSG:4326')
-education['Lat']= education.geometry.y
-education['Long']= education.geometry.x
-education = education.reset_index().rename(columns = {'index':'id_edu'})
-print('education data loaded')
-
-## hospital
-#health_facilities = gpd.read_file(path_data_files+'bgd_poi_healthfacilities_lged/bgd_poi_healthfacilities_lged.shp',crs = 'EPSG:3106')
-#hospital = health_facilities[health_facilities['FType']=='Hospital']
-hospital_path = os.path.join(path_data_files, 'critical_infra/cegis_buildings/Hospitals/Hospitals.shp')
-hospital = gpd.read_file(hospital_path, crs = 'EPSG:4326')
-hospital = hospital.to_crs('EPSG:4326')
-hospital['Lat']= hospital.geometry.y
-hospital['Long']= hospital.geometry.x
-hospital = hospital.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_hospital'})
-print('hospital data loaded')
-
-### health facilities
-health_path = os.path.join(path_data_files, 'critical_infra/cegis_buildings/Health_facilities/Health_Facilities.shp')
-health = gpd.read_file(health_path, crs = 'EPSG:4326')
-#health = health_facilities[health_facilities['FType']!='Hospital']
-health = health.to_crs('EPSG:4326')
-health['Lat']= health.geometry.y
-health['Long']= health.geometry.x
-health = health.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_health'})
-print('health data loaded')
-
-## shelters
-shelters_path = os.path.join(path_data_files,'critical_infra/Shelters/cyclone_shelters.shp')
-shelters = gpd.read_file(shelters_path)
-shelters =shelters.to_crs('EPSG:4326')
-shelters['Lat']= shelters.geometry.y
-shelters['Long']= shelters.geometry.x
-shelters = shelters.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_shelter'})
-print('shelter data loaded')
-
-## urban road
-#road_file = gpd.read_file(path_data_files+'bgd_trs_roads_lged/bgd_trs_roads_lged.shp')
-#road = road_file[road_file['FType'].isin(['National Highway','Regional Highway','Zila Road'])].reset_index(drop = True)
-#road =road.to_crs('EPSG:4326')
-#road['Lat']= road.geometry.centroid.y
-#road['Long']= road.geometry.centroid.x
-#road = road.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_road'})
-
-## rural road
-#road_rural = road_file[~road_file['FType'].isin(['National Highway','Regional Highway','Zila Road'])].reset_index(drop = True)
-#road_rural =road_rural.to_crs('EPSG:4326')
-#road_rural['Lat']= road_rural.geometry.centroid.y
-#road_rural['Long']= road_rural.geometry.centroid.x
-#road_rural = road_rural.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_road_rural'})
-
-### embankments polygon
-embankment_path = os.path.join(path_data_files, 'critical_infra/Embankments/Polder_boundary.shp')
-embankment = gpd.read_file(embankment_path)
-embankment =embankment.to_crs('EPSG:4326')
-
-### embankments points
-embankment_point_path = os.path.join(path_data_files,'critical_infra/Embankments/embankment_points.gpkg')
-embankment_point = gpd.read_file(embankment_point_path)
-embankment_point =embankment_point.to_crs('EPSG:4326')
-embankment_point['Lat']= embankment_point.geometry.y
-embankment_point['Long']= embankment_point.geometry.x
-embankment_point= embankment_point.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_embank'})
-
-### cities
-#urban_city_path = path_data_files+'Cities/'
-#cities = gpd.read_file(urban_city_path+'GHS_STAT_UCDB2015MT_GLOBE_R2019A_V1_2_short_pnt.gpkg')
-#cities['Lat']= cities.geometry.y
-#cities['Long']= cities.geometry.x
-#cities['id_urban'] = cities.ID_HDC_G0
-
-### coastline
-#coast = gpd.read_file(path_data_files+'Coastline/coastline_bangladesh.gpkg').explode()
-#coast= coast.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_coast'})
-#coast['Lat']= coast.geometry.y
-#coast['Long']= coast.geometry.x
-
-### growth centre
-growth_centre_path = os.path.join(path_data_files, 'critical_infra/Growth_centre_locations/G_Centre_BTM.shp')
-growth_centre = gpd.read_file(growth_centre_path)
-growth_centre =growth_centre.to_crs('EPSG:4326')
-growth_centre['Lat']= growth_centre.geometry.y
-growth_centre['Long']= growth_centre.geometry.x
-growth_centre= growth_centre.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_growth'})
-
-### electricity grid
-#elec_grid = gpd.read_file(path_data_files+'Electricity/MajorPowerGridLine.shp')
-#elec_grid =elec_grid.to_crs('EPSG:4326')
-#elec_grid['Lat']= elec_grid.geometry.centroid.y
-#elec_grid['Long']= elec_grid.geometry.centroid.x
-#elec_grid= elec_grid.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_grid'})
-
-### electricity substation
-elec_sub_path = os.path.join(path_data_files, 'energy/cegis_energy/Electricity/Existing_Sub_station.shp')
-elec_sub = gpd.read_file(elec_sub_path)
-elec_sub = elec_sub.to_crs('EPSG:4326')
-elec_sub['Lat']= elec_sub.geometry.y
-elec_sub['Long']= elec_sub.geometry.x
-elec_sub= elec_sub.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_substation'})
-
-## railway stations
-rail_station_path = os.path.join(path_data_files, 'transport/cegis_transport/Railway/Railway_Stations.shp')
-rail_station = gpd.read_file(rail_station_path)
-rail_station = rail_station.to_crs('EPSG:4326')
-rail_station['Lat']= rail_station.geometry.y
-rail_station['Long']= rail_station.geometry.x
-rail_station = rail_station.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_railstation'})
-
-## road nodes
-road_node_path = os.path.join(path_data_files, 'transport/osm_road_corrected/osm_road_nodes_corrected.gpkg')
-road_node = gpd.read_file(road_node_path)
-road_node = road_node.to_crs('EPSG:4326')
-road_node['Lat']= road_node.geometry.y
-road_node['Long']= road_node.geometry.x
-road_node = road_node.reset_index(drop = True).reset_index().rename(columns  = {'index':'id_roadnode'})
-
-print('data loaded')
-
-##### list districts
-list_district = ['Noakhali','Khulna','Barisal','Satkhira','Bhola','Bagerhat','Patuakhali','Barguna','Pirojpur','Jhalokati','Narail','Chittagong','Jessore', 'Chandpur','Coxs_Bazar','Lakshmipur','Feni','Shariatpur','Gopalganj']
-#path_hh_data = 'Output/Processed_households/'
-path_hh_data = os.path.join(base_path,'incoming/Population/WB_household_data_jasper/Household_data/Synthetic_data_coded/')
-
-
-for district in list_district:
-    print(district)
-    district_urban = pd.read_csv(path_hh_data+'urban_'+str(district)+'.csv')
-    district_rural = pd.read_csv(path_hh_data+'rural_'+str(district)+'.csv')
-
-    urban_data = district_urban[['hid','htype_class','Long','Lat','electric_class','water_class','toilet_class']].copy()
-    rural_data = district_rural[['hid','htype_class','Long','Lat','electric_class','water_class','toilet_class']].copy()
-    del district_urban, district_rural
-    urban_data_infra = run_accessibility(urban_data)
-    rural_data_infra = run_accessibility(rural_data)
-
-    urban_path = os.path.join(base_path, 'data/household_asset_analysis/Infra_access/urban_infra_access_'+str(district)+'.csv')
-    urban_data_infra.to_csv(urban_path, index = False)
-    rural_path = os.path.join(base_path, 'data/household_asset_analysis/Infra_access/rural_infra_access_'+str(district)+'.csv')
-    rural_data_infra.to_csv(rural_path, index = False)
+    with instrumentation.stage('polder membership', rows_in=len(gdf)):
+        polder_index = polder_membership(gdf.geometry.to_numpy(), polders)
+        in_polder = polder_index >= 0
+        gdf['polder'] = in_polder.astype('int8')
+        gdf['Polder no.'] = pd.Series(polders.polder_no[polder_index.clip(0)], index=gdf.index).where(in_polder, 0)
+
+    ### nearest assets
+    lat_lon = lat_lon_radians(gdf, ['longitude', 'latitude'])
+    with instrumentation.stage('nearest assets', rows_in=len(gdf)):
+        nearest = nearest_assets(lat_lon, asset_layers, k_nearest)
+    with instrumentation.stage('count assets within', rows_in=len(gdf)):
+        counts = count_assets_within(lat_lon, asset_layers, radii_km)
+    columns = {}
+    for layer in asset_layers:
+        ids, distances = nearest[layer.name]
+        columns[layer.id_column] = ids
+        columns['dist_' + layer.name] = distances[:, 0]
+        for k in range(2, distances.shape[1] + 1):
+            columns[f'dist_{layer.name}_{k}'] = distances[:, k - 1]
+    for layer in asset_layers:
+        for i, radius_km in enumerate(radii_km.get(layer.name, [])):
+            columns[f'count_{layer.name}_{radius_km:g}km'] = counts[layer.name][:, i]
+    if road_distances:
+        # roadnode ids are road node positions in the road graph
+        road_node, road_node_distance = nearest['roadnode']
+        for name, node_distances in road_distances.items():
+            columns[f'netdist_{name}'] = road_node_distance[:, 0] + node_distances[road_node]
+    return pd.concat([gdf, pd.DataFrame(columns, index=gdf.index)], axis=1)
+
+
+def read_polders(path_data_files):
+    """Read the polder boundaries, returning a PolderIndex"""
+    embankment_path = os.path.join(path_data_files, 'critical_infra/Embankments/Polder_boundary.shp')
+    with instrumentation.stage('read assets', layer='embankment') as record:
+        embankment = gpd.read_file(embankment_path)
+        record['rows_out'] = len(embankment)
+    return build_polder_index(embankment.to_crs('EPSG:4326'))
+
+
+def load_asset_layers(path_data_files, index_dir):
+    """Load the tree for each asset layer, building any not yet in the index store"""
+    return [
+        load_asset_layer(name, os.path.join(path_data_files, path), id_column, index_dir)
+        for name, path, id_column in ASSET_SOURCES
+    ]
+
+
+def process_district(district, settlement, path_hh_data, dataset_dir, polders, asset_layers, road_distances=None):
+    """Find nearest assets for the households of one district and settlement type
+
+    Writes one partition of the infra access dataset, which exists only
+    once complete, so can be used as a checkpoint.
+    """
+    with instrumentation.stage('read households', district=district, settlement=settlement) as record:
+        data = pd.read_csv(os.path.join(path_hh_data, f"{settlement}_{district}.csv"), usecols=HOUSEHOLD_COLUMNS)
+        # keep the column order of the output
+        data = data[HOUSEHOLD_COLUMNS]
+        record['rows_out'] = len(data)
+    with instrumentation.stage('accessibility', rows_in=len(data), district=district, settlement=settlement) as record:
+        data_infra = run_accessibility(data, polders, asset_layers, road_distances=road_distances)
+        record['rows_out'] = len(data_infra)
+    with instrumentation.stage('write infra access', rows_in=len(data_infra), district=district, settlement=settlement):
+        infra_access.write_infra_access(data_infra, dataset_dir, district, settlement)
+    return len(data_infra)
+
+
+def run_districts(jobs, path_hh_data, dataset_dir, path_data_files, index_dir, processes=1, network_distance=False):
+    """Run (district, settlement) jobs, in a process pool if processes > 1
+
+    If network_distance, also finds distances along roads. The road graph
+    is read and searched once, in this process, and the distances from each
+    road node passed to any workers.
+
+    Jobs with an existing partition in the infra access dataset are skipped, so a stopped run resumes
+    where it left off. A job that raises is reported and returned in the
+    list of failed jobs, without stopping the remaining jobs.
+    """
+    todo = [job for job in jobs if not os.path.exists(infra_access.partition_fname(dataset_dir, *job))]
+    print(f'{len(jobs) - len(todo)} of {len(jobs)} district outputs already exist, skipping')
+
+    # build any missing trees once, before any workers load them memory-mapped
+    asset_layers = load_asset_layers(path_data_files, index_dir)
+    road_distances = load_road_distances(path_data_files, asset_layers) if network_distance else None
+
+    failed = []
+    if processes == 1:
+        polders = read_polders(path_data_files)
+        for n, (district, settlement) in enumerate(todo, start=1):
+            try:
+                _, stages = instrumentation.call_recorded(
+                    process_district, district, settlement, path_hh_data, dataset_dir, polders, asset_layers,
+                    road_distances)
+                instrumentation.add_stages(stages)
+                print(f'[{n}/{len(todo)}] done', district, settlement)
+            except Exception:
+                traceback.print_exc()
+                print(f'[{n}/{len(todo)}] error in', district, settlement)
+                failed.append((district, settlement))
+        return failed
+
+    with ProcessPoolExecutor(
+            processes, initializer=init_worker, initargs=(path_data_files, index_dir, road_distances)) as executor:
+        futures = {
+            executor.submit(instrumentation.call_recorded, process_district_in_worker, district, settlement, path_hh_data, dataset_dir): (district, settlement)
+            for district, settlement in todo
+        }
+        for n, future in enumerate(as_completed(futures), start=1):
+            district, settlement = futures[future]
+            try:
+                _, stages = future.result()
+                instrumentation.add_stages(stages)
+                print(f'[{n}/{len(todo)}] done', district, settlement)
+            except Exception:
+                traceback.print_exc()
+                print(f'[{n}/{len(todo)}] error in', district, settlement)
+                failed.append((district, settlement))
+    return failed
+
+
+# Polder boundaries, asset layers and road distances, loaded once per worker process
+_worker_polders = None
+_worker_asset_layers = None
+_worker_road_distances = None
+
+
+def init_worker(path_data_files, index_dir, road_distances):
+    """Load polder boundaries and asset layers (memory-mapped) in a worker process
+
+    road_distances (or None) are found once, by the parent process.
+    """
+    global _worker_polders, _worker_asset_layers, _worker_road_distances
+    _worker_polders = read_polders(path_data_files)
+    _worker_asset_layers = load_asset_layers(path_data_files, index_dir)
+    _worker_road_distances = road_distances
+
+
+def process_district_in_worker(district, settlement, path_hh_data, dataset_dir):
+    return process_district(
+        district, settlement, path_hh_data, dataset_dir, _worker_polders, _worker_asset_layers,
+        _worker_road_distances)
+
+
+if __name__ == '__main__':
+    #path_data_files = 'Input_data/' #jaspers code
+    base_path = os.path.join('D:/Bangladesh')
+    path_data_files = os.path.join(base_path,'incoming')
+    index_dir = os.path.join(base_path, 'data/household_asset_analysis/asset_indexes')
+    #path_hh_data = 'Output/Processed_households/'
+    path_hh_data = os.path.join(base_path,'incoming/Population/WB_household_data_jasper/Household_data/Synthetic_data_coded/')
+    dataset_dir = os.path.join(base_path, 'data/household_asset_analysis/infra_access.parquet')
+    processes = 1
+    network_distance = False
+
+    ##### list districts
+    list_district = ['Noakhali','Khulna','Barisal','Satkhira','Bhola','Bagerhat','Patuakhali','Barguna','Pirojpur','Jhalokati','Narail','Chittagong','Jessore', 'Chandpur','Coxs_Bazar','Lakshmipur','Feni','Shariatpur','Gopalganj']
+    jobs = [(district, settlement) for district in list_district for settlement in ('urban', 'rural')]
+
+    failed = run_districts(jobs, path_hh_data, dataset_dir, path_data_files, index_dir, processes, network_distance)
+    if failed:
+        print('failed:', failed)
+
+    instrumentation.write_report(
+        instrumentation.report_fname('infrastructure-services-nn', os.path.join(base_path, 'data/household_asset_analysis/run_reports')),
+        processes=processes, network_distance=network_distance, failed=failed)
@@ -0,0 +1,220 @@
+"""Record time, memory, rows and bytes per named stage of a script run
+
+Wrap each stage in a `stage` block, then write a JSON run report at the
+end:
+
+    import instrumentation
+
+    with instrumentation.stage("read households", district=district) as record:
+        df = pandas.read_csv(path)
+        record['rows_out'] = len(df)
+
+    instrumentation.write_report(instrumentation.report_fname("script-name", out_dir))
+
+Each stage records wall time, CPU time, peak resident memory, rows in and
+out, and bytes read and written. Stages may be nested. Peak memory is per
+stage on Linux, where the peak can be reset, and the process peak so far on
+macOS and Windows (peak_rss_scope 'stage' or 'process'). Where it cannot be
+read at all, it is None, with peak_rss_scope 'unavailable'. Bytes are counted
+by read and write system calls on Linux, so include reads served from the
+page cache, and are None elsewhere.
+"""
+import contextlib
+import ctypes
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+# Finished stages, in order of completion
+STAGES = []
+
+# Stages in progress, innermost last
+_open_stages = []
+
+_started = datetime.datetime.now()
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None, **labels):
+    """Record a named stage, with optional labels such as a layer or district
+
+    Yields the stage's record, a dict, so that rows_out (or any other
+    value) can be set within the block.
+    """
+    if _open_stages:
+        # resetting the peak below loses the parent's peak so far, so keep it
+        parent = _open_stages[-1]
+        parent['peak_rss_mb'] = _max_peak(parent['peak_rss_mb'], peak_rss_mb())
+    if reset_peak_rss():
+        peak_scope = 'stage'
+    else:
+        peak_scope = 'process' if peak_rss_mb() is not None else 'unavailable'
+
+    record = {
+        'name': name,
+        'labels': labels,
+        'parent': _open_stages[-1]['name'] if _open_stages else None,
+        'rows_in': rows_in,
+        'rows_out': None,
+        'peak_rss_mb': None,
+        'peak_rss_scope': peak_scope,
+    }
+    _open_stages.append(record)
+    io_start = read_io()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        io_end = read_io()
+        io_known = io_start is not None and io_end is not None
+        record['bytes_read'] = io_end['rchar'] - io_start['rchar'] if io_known else None
+        record['bytes_written'] = io_end['wchar'] - io_start['wchar'] if io_known else None
+        record['peak_rss_mb'] = _max_peak(record['peak_rss_mb'], peak_rss_mb())
+        _open_stages.pop()
+        if _open_stages:
+            parent = _open_stages[-1]
+            parent['peak_rss_mb'] = _max_peak(parent['peak_rss_mb'], record['peak_rss_mb'])
+        STAGES.append(record)
+        logging.debug(
+            "Stage %s %s: %.2fs wall, %.2fs CPU, %s MB peak", name, labels, record['wall_seconds'],
+            record['cpu_seconds'], record['peak_rss_mb'])
+
+
+def call_recorded(fn, *args, **kwargs):
+    """Call fn, returning its result and the stages it recorded
+
+    For use in worker processes, whose stages would otherwise be lost: pass
+    the returned stages to add_stages in the parent process.
+    """
+    start = len(STAGES)
+    result = fn(*args, **kwargs)
+    stages = STAGES[start:]
+    del STAGES[start:]
+    return result, stages
+
+
+def add_stages(stages, **labels):
+    """Add stages recorded elsewhere, for example in a worker process"""
+    for record in stages:
+        record['labels'] = {**labels, **record['labels']}
+        STAGES.append(record)
+
+
+def _max_peak(a, b):
+    """Greater of two peaks, either of which may be None if unknown"""
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, b)
+
+
+def peak_rss_mb():
+    """Peak resident set size, in MB, since the last reset or process start, or None if unknown"""
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+    if sys.platform == "win32":
+        return _windows_peak_working_set_mb()
+    return None
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    # PROCESS_MEMORY_COUNTERS, from psapi.h
+    _fields_ = [
+        ('cb', ctypes.c_ulong),
+        ('PageFaultCount', ctypes.c_ulong),
+        ('PeakWorkingSetSize', ctypes.c_size_t),
+        ('WorkingSetSize', ctypes.c_size_t),
+        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+        ('PagefileUsage', ctypes.c_size_t),
+        ('PeakPagefileUsage', ctypes.c_size_t),
+    ]
+
+
+def _windows_peak_working_set_mb():
+    """Peak working set of this process, in MB, or None if unknown (Windows only)"""
+    try:
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        psapi = ctypes.WinDLL('psapi')
+        process = ctypes.WinDLL('kernel32').GetCurrentProcess()
+        if not psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+    except (AttributeError, OSError):
+        return None
+    return counters.PeakWorkingSetSize / 2**20
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size, if possible (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_io():
+    """Bytes read and written by this process so far, or None if unknown"""
+    try:
+        with open("/proc/self/io") as fh:
+            return {key: int(value) for key, value in (line.split(":") for line in fh)}
+    except OSError:
+        return None
+
+
+def report_fname(script_name, out_dir):
+    """Timestamped report file name for a run of a script"""
+    return os.path.join(out_dir, f"{script_name}__{_started:%Y%m%d-%H%M%S}__{os.getpid()}.json")
+
+
+def write_report(fname, **meta):
+    """Write all stages recorded so far as a JSON run report
+
+    Also logs the stages which took longest, as a summary.
+    """
+    report = {
+        'started': _started.isoformat(timespec='seconds'),
+        'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+        'argv': sys.argv,
+        'hostname': platform.node(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'meta': meta,
+        'stages': STAGES,
+    }
+    os.makedirs(os.path.dirname(fname) or ".", exist_ok=True)
+    with open(fname, "w") as fh:
+        json.dump(report, fh, indent=2, default=str)
+
+    totals = {}
+    for record in STAGES:
+        totals[record['name']] = totals.get(record['name'], 0) + record['wall_seconds']
+    for name, seconds in sorted(totals.items(), key=lambda item: -item[1])[:10]:
+        logging.info("  %s: %.2fs", name, seconds)
+    logging.info("Wrote run report %s", fname)
@@ -1,24 +1,78 @@
 #!/usr/bin/env python
 # coding: utf-8
+import glob
+import hashlib
 import json
 import logging
+import math
+import multiprocessing
 import os
+import re
+import shutil
+import sqlite3
 import sys
 import warnings
 
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 
 import fiona
 import geopandas
 import numpy
 import pandas
+import pyarrow.parquet
+import pyogrio
+import pyproj
 import rasterio
+import shapely
 
+from affine import Affine
+from rasterio.windows import Window
 from shapely.geometry import mapping, shape
-from shapely.ops import linemerge, polygonize
-from snail.core.intersections import get_cell_indices, split_linestring, split_polygon
+from shapely.ops import polygonize
+from snail.core.intersections import split_linestring, split_polygon
 from tqdm import tqdm
 
+import instrumentation
+
+
+# Helper class to store a raster transform and CRS
+Transform = namedtuple('Transform', ['crs', 'width', 'height', 'transform'])
+
+# Helper class to store split output: positions of the parent rows, and the
+# split geometries
+Splits = namedtuple('Splits', ['parent', 'geometry'])
+
+# Helper class to store grid cell coverage: positions of the parent rows, cell
+# indices and the fraction of each cell covered
+Coverage = namedtuple('Coverage', ['parent', 'col', 'row', 'fraction'])
+
+# Helper class to store run options
+# - read_mode: how much of each hazard raster to read, see read_values, or
+#   "cube" to read from hazard cubes, see build_hazard_cubes
+# - processes: number of (network, layer) jobs to run in parallel
+# - split_processes: number of processes used to split lines within a layer
+# - split_chunksize: number of lines per split job
+# - write_batch_size: number of split pieces to join with attributes and write at once
+# - cache_dir: directory to cache split pieces per (network layer, transforms), or None
+# - incremental: add only missing hazard columns to existing output layers
+# - area_mode: "split" areas into pieces per grid cell, or summarise hazards
+#   over cell "coverage" per area, see process_area_coverage
+# - output_format: "gpkg" or "parquet" (GeoParquet), see write_output
+# - row_group_size: maximum rows per GeoParquet row group
+# - compression: GeoParquet compression codec
+# - partition_by: GeoParquet partitions, any of "sector" and "transform"
+# - tile_cells: (columns, rows) of the first transform's cells to read and
+#   process at a time, or None to read whole layers, see read_tiles
+# - cube_dir: directory of hazard cubes, for read_mode "cube"
+Options = namedtuple(
+    'Options',
+    ['read_mode', 'processes', 'split_processes', 'split_chunksize', 'write_batch_size', 'cache_dir',
+     'incremental', 'area_mode', 'output_format', 'row_group_size', 'compression', 'partition_by',
+     'tile_cells', 'cube_dir'],
+    defaults=['window', 1, 1, 10000, 100000, None, False, 'split', 'gpkg', 100000, 'zstd', (), None, None]
+)
 
 
 def load_config():
@@ -29,82 +83,714 @@ def load_config():
     return config
 
 
-def main(data_path, networks_csv, hazards_csv):
+def main(data_path, networks_csv, hazards_csv, options=Options()):
     # read transforms, record with hazards
     hazards = pandas.read_csv(hazards_csv)
     hazard_slug = os.path.basename(hazards_csv).replace(".csv", "")
-    hazard_transforms, transforms = read_transforms(hazards, data_path)
+    with instrumentation.stage("read transforms", rows_in=len(hazards)) as record:
+        hazard_transforms, transforms = read_transforms(hazards, data_path)
+        record['rows_out'] = len(transforms)
     hazard_transforms.to_csv(hazards_csv.replace(".csv", "__with_transforms.csv"), index=False)
 
+    if options.read_mode == 'cube':
+        if options.cube_dir is None:
+            raise ValueError("read_mode 'cube' needs cube_dir")
+        # stack the hazards on each grid, for reading all at once
+        with instrumentation.stage("build hazard cubes", rows_in=len(hazards)):
+            build_hazard_cubes(hazard_transforms, data_path, options.cube_dir)
+
     # read networks
     networks = pandas.read_csv(networks_csv)
 
-    for network_path in networks.path:
+    # sector of each network, used to partition GeoParquet output
+    if 'sector' in networks.columns:
+        sectors = networks.sector
+    else:
+        sectors = networks.path.map(lambda path: os.path.basename(os.path.dirname(path)))
+
+    # collect (network, layer) jobs
+    jobs = []
+    for network_path, sector in zip(networks.path, sectors):
         fname = os.path.join(data_path, network_path)
         out_fname = os.path.join(
             data_path, "results", "hazard_asset_intersection",
             os.path.basename(network_path).replace(".gpkg", f"_splits__{hazard_slug}.gpkg")
         )
-        pq_fname_nodes = out_fname.replace(".gpkg","__nodes.geoparquet")
-        print(pq_fname_nodes)
-        pq_fname_edges = out_fname.replace(".gpkg","__edges.geoparquet")
-        pq_fname_areas = out_fname.replace(".gpkg","__areas.geoparquet")
 
         # skip if output is there already (not using gpkg currently)
         # if os.path.exists(out_fname):
         #     logging.info("Skipping %s. Already exists: %s", os.path.basename(fname), out_fname)
         #     continue
 
-        logging.info("Processing %s", os.path.basename(fname))
         layers = fiona.listlayers(fname)
-        logging.info("Layers: %s", layers)
-
-        if "nodes" in layers:
-            # skip if output is there already
-            if os.path.exists(pq_fname_nodes):
-                logging.info("Skipping %s. Already exists: %s", os.path.basename(fname), pq_fname_nodes)
-            else:
-                # look up nodes cell index
-                nodes = geopandas.read_file(fname, layer="nodes")
-                logging.info("Node CRS %s", nodes.crs)
-                nodes = process_nodes(nodes, transforms, hazard_transforms, data_path)
-                nodes.to_file(out_fname, driver="GPKG", layer="nodes")
-                #nodes.to_parquet(pq_fname_nodes)
-
-        if "edges" in layers:
-            # skip if output is there already
-            if os.path.exists(pq_fname_edges):
-                logging.info("Skipping %s. Already exists: %s", os.path.basename(fname), pq_fname_edges)
-            else:
-                # split lines
-                edges = geopandas.read_file(fname, layer="edges")
-                logging.info("Edge CRS %s", edges.crs)
-                edges = process_edges(edges, transforms, hazard_transforms, data_path)
-                edges.to_file(out_fname, driver="GPKG", layer="edges")
-                #edges.to_parquet(pq_fname_edges)
-
-        if "areas" in layers:
-            # skip if output is there already
-            if os.path.exists(pq_fname_areas):
-                logging.info("Skipping %s. Already exists: %s", os.path.basename(fname), pq_fname_areas)
-            else:
-                # split polygons
-                areas = geopandas.read_file(fname, layer="areas")
-                logging.info("Area CRS %s", areas.crs)
-                areas = explode_multi(areas)
-                areas = process_areas(areas, transforms, hazard_transforms, data_path)
-                areas.to_file(out_fname, driver="GPKG", layer="areas")
-                #areas.to_parquet(pq_fname_areas)
+        logging.info("Layers in %s: %s", os.path.basename(fname), layers)
+        network_hash = hash_file(fname) if options.cache_dir is not None else None
 
+        for layer in ("nodes", "edges", "areas"):
+            if layer not in layers:
+                continue
+            job = LayerJob(fname, layer, out_fname, network_hash, sector)
+            # skip if output is there already, unless adding hazards to it
+            if options.output_format == 'parquet' and not options.incremental and output_exists(job, options):
+                logging.info(
+                    "Skipping %s %s. Already exists: %s", os.path.basename(fname), layer,
+                    parquet_dataset(job, options)[0])
+                continue
+            jobs.append(job)
 
-# Helper class to store a raster transform and CRS
-Transform = namedtuple('Transform', ['crs', 'width', 'height', 'transform'])
+    with instrumentation.stage("run jobs", rows_in=len(jobs)):
+        failed = run_jobs(jobs, transforms, hazard_transforms, data_path, options)
+    for job in failed:
+        logging.error("Failed %s %s", os.path.basename(job.fname), job.layer)
+
+    instrumentation.write_report(
+        instrumentation.report_fname("intersection-snail", os.path.join(data_path, "results", "run_reports")),
+        networks_csv=networks_csv, hazards_csv=hazards_csv, options=options._asdict(),
+        failed=[f"{os.path.basename(job.fname)} {job.layer}" for job in failed])
+
+
+# Helper class to store a single (network, layer) unit of work
+LayerJob = namedtuple(
+    'LayerJob', ['fname', 'layer', 'out_fname', 'network_hash', 'sector'], defaults=[None, None])
+
+
+def run_jobs(jobs, transforms, hazard_transforms, data_path, options=Options()):
+    """Run (network, layer) jobs, in a process pool if options.processes > 1
+
+    A job that raises is logged and returned in the list of failed jobs,
+    without stopping the remaining jobs. Stages recorded by each job are
+    labelled with its network and layer.
+    """
+    failed = []
+    if options.processes == 1:
+        for n, job in enumerate(jobs, start=1):
+            try:
+                _, stages = instrumentation.call_recorded(
+                    process_layer, job, transforms, hazard_transforms, data_path, options)
+                instrumentation.add_stages(stages, network=os.path.basename(job.fname), layer=job.layer)
+                logging.info("[%d/%d] Done %s %s", n, len(jobs), os.path.basename(job.fname), job.layer)
+            except Exception:
+                logging.exception("[%d/%d] Error in %s %s", n, len(jobs), os.path.basename(job.fname), job.layer)
+                failed.append(job)
+        return failed
+
+    with multiprocessing.Manager() as manager, \
+            ProcessPoolExecutor(options.processes, initializer=init_worker) as executor:
+        # layers of one network share an output GPKG, so serialise writes to each file
+        locks = {out_fname: manager.Lock() for out_fname in set(job.out_fname for job in jobs)}
+        futures = {
+            executor.submit(
+                instrumentation.call_recorded,
+                process_layer, job, transforms, hazard_transforms, data_path, options,
+                locks[job.out_fname]): job
+            for job in jobs
+        }
+        for n, future in enumerate(as_completed(futures), start=1):
+            job = futures[future]
+            try:
+                _, stages = future.result()
+                instrumentation.add_stages(stages, network=os.path.basename(job.fname), layer=job.layer)
+                logging.info("[%d/%d] Done %s %s", n, len(jobs), os.path.basename(job.fname), job.layer)
+            except Exception:
+                logging.exception("[%d/%d] Error in %s %s", n, len(jobs), os.path.basename(job.fname), job.layer)
+                failed.append(job)
+    return failed
+
+
+def init_worker():
+    """Set up warnings and logging in a worker process"""
+    warnings.filterwarnings('ignore', message='.*initial implementation of Parquet.*')
+    warnings.filterwarnings('ignore', message='.*Sequential read of iterator was interrupted.*')
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+def process_layer(job, transforms, hazard_transforms, data_path, options=Options(), lock=None):
+    """Read, process and write a single network layer"""
+    lock = lock if lock is not None else nullcontext()
+    if options.incremental and output_exists(job, options):
+        with instrumentation.stage("append hazards"):
+            appended = append_hazards(job, transforms, hazard_transforms, data_path, options, lock)
+        if appended:
+            return
+
+    logging.info("Processing %s %s", os.path.basename(job.fname), job.layer)
+    if options.tile_cells is None:
+        with instrumentation.stage("read layer") as record:
+            tiles = [(None, geopandas.read_file(job.fname, layer=job.layer))]
+            record['rows_out'] = len(tiles[0][1])
+    else:
+        # stream tiles through processing and writing
+        tiles = read_tiles(job.fname, job.layer, transforms[0], options.tile_cells)
+
+    batches = (
+        batch
+        for tile, df in tiles
+        for batch in process_tile(df, tile, job, transforms, hazard_transforms, data_path, options)
+    )
+    with instrumentation.stage("process layer"):
+        write_output(batches, job, transforms, hazard_transforms, options, lock)
+
+
+def process_tile(df, tile, job, transforms, hazard_transforms, data_path, options=Options()):
+    """Process a layer, or one tile of it, yielding batches of output features"""
+    logging.info("%s CRS %s, tile %s, %d features", job.layer, df.crs, tile, len(df))
+
+    if job.layer == "nodes" or (job.layer == "areas" and options.area_mode == 'coverage'):
+        if job.layer == "nodes":
+            # look up nodes cell index
+            with instrumentation.stage("process nodes", rows_in=len(df)) as record:
+                df = process_nodes(df, transforms, hazard_transforms, data_path, options)
+                record['rows_out'] = len(df)
+        else:
+            # summarise hazards over the cells each area covers
+            with instrumentation.stage("area coverage", rows_in=len(df)) as record:
+                df = process_area_coverage(df, transforms, hazard_transforms, data_path, options)
+                record['rows_out'] = len(df)
+        for start in range(0, max(len(df), 1), options.write_batch_size):
+            yield df.iloc[start:start + options.write_batch_size]
+        return
+
+    # cache splits per network layer, or layer tile
+    cache_key = None
+    if options.cache_dir is not None and job.network_hash is not None:
+        cache_key = f"{job.network_hash}:{job.layer}"
+        if tile is not None:
+            # split pieces refer to features by position in the tile, so key
+            # by the tile size and the tile's features, in order
+            cache_key = f"{cache_key}:{options.tile_cells}:{tile}:{hash_features(df)}"
+
+    with instrumentation.stage(f"process {job.layer}", rows_in=len(df)) as record:
+        if job.layer == "edges":
+            # split lines
+            splits = process_edges(df, transforms, hazard_transforms, data_path, options, cache_key)
+        elif job.layer == "areas":
+            # split polygons
+            splits = process_areas(df, transforms, hazard_transforms, data_path, options, cache_key)
+        record['rows_out'] = len(splits)
+
+    # join attributes onto split pieces one batch at a time, while writing
+    for start in range(0, max(len(splits), 1), options.write_batch_size):
+        yield join_attributes(df, splits.iloc[start:start + options.write_batch_size])
+
+
+def hash_features(df):
+    """Hash of the bounds and geometries of features, in order"""
+    features_hash = hashlib.sha256(numpy.asarray(df.total_bounds).tobytes())
+    for wkb in shapely.to_wkb(df.geometry.values):
+        features_hash.update(wkb)
+    return features_hash.hexdigest()
+
+
+def read_tiles(fname, layer, t, tile_cells):
+    """Read a network layer one tile at a time
+
+    Tiles are tile_cells (columns, rows) of the cells of grid t. Each
+    feature is read with the one tile containing its representative point,
+    a point on the feature, so features crossing tile boundaries are
+    processed once, whole. Tiles on the edge of the grid extend to cover
+    the layer. Yields ((tile_column, tile_row), features) for each tile
+    with features in it.
+    """
+    info = pyogrio.read_info(fname, layer=layer, force_total_bounds=True)
+    to_grid = pyproj.Transformer.from_crs(info['crs'], t.crs, always_xy=True)
+    from_grid = pyproj.Transformer.from_crs(t.crs, info['crs'], always_xy=True)
+    affine = Affine(*t.transform[:6])
+    tile_width, tile_height = tile_cells
+    n_tile_cols = math.ceil(t.width / tile_width)
+    n_tile_rows = math.ceil(t.height / tile_height)
+
+    # layer extent in cell coordinates
+    col, row = cell_coordinates(*box_corners(to_grid.transform_bounds(*info['total_bounds'])), affine)
+    tile_cols = numpy.clip(numpy.floor([col.min() / tile_width, col.max() / tile_width]), 0, n_tile_cols - 1)
+    tile_rows = numpy.clip(numpy.floor([row.min() / tile_height, row.max() / tile_height]), 0, n_tile_rows - 1)
+
+    for tile_col in range(int(tile_cols[0]), int(tile_cols[1]) + 1):
+        for tile_row in range(int(tile_rows[0]), int(tile_rows[1]) + 1):
+            # tile extent in cell coordinates, padded by a cell, extended on the grid edges
+            col_min = tile_col * tile_width if tile_col > 0 else min(col.min(), 0)
+            col_max = (tile_col + 1) * tile_width if tile_col < n_tile_cols - 1 else max(col.max(), t.width)
+            row_min = tile_row * tile_height if tile_row > 0 else min(row.min(), 0)
+            row_max = (tile_row + 1) * tile_height if tile_row < n_tile_rows - 1 else max(row.max(), t.height)
+            x, y = affine * box_corners((col_min - 1, row_min - 1, col_max + 1, row_max + 1))
+            bbox = from_grid.transform_bounds(x.min(), y.min(), x.max(), y.max())
+
+            with instrumentation.stage("read tile") as record:
+                df = geopandas.read_file(fname, layer=layer, bbox=bbox)
+                record['rows_in'] = len(df)
+                # keep features with their representative point in this tile
+                points = shapely.point_on_surface(df.geometry.values)
+                col_point, row_point = cell_coordinates(
+                    *to_grid.transform(shapely.get_x(points), shapely.get_y(points)), affine)
+                in_tile = (
+                    (numpy.clip(numpy.floor(col_point / tile_width), 0, n_tile_cols - 1) == tile_col)
+                    & (numpy.clip(numpy.floor(row_point / tile_height), 0, n_tile_rows - 1) == tile_row)
+                )
+                df = df[in_tile].reset_index(drop=True)
+                record['rows_out'] = len(df)
+            if not df.empty:
+                yield (tile_col, tile_row), df
+
+
+def box_corners(bounds):
+    """Corner coordinate arrays of a (minx, miny, maxx, maxy) box"""
+    minx, miny, maxx, maxy = bounds
+    return numpy.array([minx, maxx, maxx, minx]), numpy.array([miny, miny, maxy, maxy])
+
+
+def cell_coordinates(x, y, affine):
+    """Fractional (column, row) cell coordinates of coordinate arrays"""
+    inverse = ~affine
+    return inverse.a * x + inverse.b * y + inverse.c, inverse.d * x + inverse.e * y + inverse.f
+
+
+def write_output(batches, job, transforms, hazard_transforms, options=Options(), lock=nullcontext()):
+    """Write batches of output features, and the transforms they refer to
+
+    GPKG output goes to a layer of the network's output file. GeoParquet
+    output goes to a dataset directory of part files, optionally
+    partitioned by transform (one set of part files per grid, each with its
+    own cell index and hazard columns) and by sector (all networks in one
+    dataset). Parts are written to a temporary directory and moved into
+    place at the end; the transforms file is written last, so marks the
+    output as complete.
+    """
+    if options.output_format == 'gpkg':
+        # hold the lock only while writing, not while batches are processed
+        for n, batch in enumerate(batches):
+            with instrumentation.stage("write batch", rows_in=len(batch)), lock:
+                batch.to_file(job.out_fname, driver="GPKG", layer=job.layer, mode='w' if n == 0 else 'a')
+        with lock:
+            write_output_transforms(output_transforms_fname(job, options), transforms)
+        return
+
+    if options.output_format != 'parquet':
+        raise ValueError(f"Unknown output_format: {options.output_format}")
+
+    dataset, network_partition = parquet_dataset(job, options)
+    tmp_dir = f"{dataset}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    part_dirs = {}
+    for n, batch in enumerate(batches):
+        if 'transform' in options.partition_by:
+            batch_columns = transform_columns(batch, hazard_transforms).items()
+        else:
+            batch_columns = [(None, batch.columns)]
+        with instrumentation.stage("write batch", rows_in=len(batch)):
+            for transform_id, columns in batch_columns:
+                part_dir = os.path.join(tmp_dir, str(transform_id))
+                os.makedirs(part_dir, exist_ok=True)
+                part_dirs[part_dir] = parquet_part_dir(dataset, network_partition, transform_id)
+                write_parquet(batch[columns], os.path.join(part_dir, f"part-{n:05d}.parquet"), options)
+
+    # replace any previous output
+    for part_dir, out_dir in part_dirs.items():
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+        os.replace(part_dir, out_dir)
+    shutil.rmtree(tmp_dir)
+    transforms_fname = output_transforms_fname(job, options)
+    os.makedirs(os.path.dirname(transforms_fname), exist_ok=True)
+    write_output_transforms(transforms_fname, transforms)
+
+
+def write_parquet(df, fname, options=Options()):
+    # covering bbox columns let readers filter by bounding box
+    df.to_parquet(
+        fname, index=False, compression=options.compression,
+        row_group_size=options.row_group_size, write_covering_bbox=True)
+
+
+def transform_columns(df, hazard_transforms):
+    """Split output columns by transform
+
+    Each transform gets its own cell index and hazard columns, plus all the
+    columns not specific to any transform (attributes and geometry).
+    """
+    column_transforms = {}
+    for hazard in hazard_transforms.itertuples():
+        for column in (hazard.key, f'{hazard.key}_mean', f'{hazard.key}_max'):
+            column_transforms[column] = hazard.transform_id
+    for transform_id in hazard_transforms.transform_id.unique():
+        for xy in ('x', 'y'):
+            column_transforms[f'cell_index_{transform_id}_{xy}'] = transform_id
+
+    shared = [c for c in df.columns if c not in column_transforms]
+    return {
+        transform_id: shared + [c for c in df.columns if column_transforms.get(c) == transform_id]
+        for transform_id in sorted(hazard_transforms.transform_id.unique())
+    }
+
+
+def parquet_dataset(job, options=Options()):
+    """GeoParquet dataset that a network layer is written to, and the
+    network's partition within it
+
+    Partitioned by sector, all networks share one dataset per layer, with a
+    sector=.../network=... partition for each network.
+    """
+    if 'sector' in options.partition_by:
+        out_dir, out_name = os.path.split(job.out_fname)
+        network, hazard_slug = out_name.replace(".gpkg", "").rsplit("_splits__", 1)
+        dataset = os.path.join(out_dir, f"{hazard_slug}__{job.layer}.geoparquet")
+        return dataset, os.path.join(f"sector={job.sector}", f"network={network}")
+    return job.out_fname.replace(".gpkg", f"__{job.layer}.geoparquet"), ""
+
+
+def parquet_part_dir(dataset, network_partition, transform_id=None):
+    """Directory of a network's part files, within a dataset
+
+    Transform partitions come first, so that each transform_id=...
+    directory can be read as a dataset with a single set of columns.
+    """
+    transform_partition = "" if transform_id is None else f"transform_id={transform_id}"
+    return os.path.join(dataset, *[p for p in (transform_partition, network_partition) if p])
+
+
+def output_exists(job, options=Options()):
+    if options.output_format == 'parquet':
+        return os.path.exists(output_transforms_fname(job, options))
+    return os.path.exists(job.out_fname) and job.layer in fiona.listlayers(job.out_fname)
+
+
+def output_transforms_fname(job, options=Options()):
+    if options.output_format == 'parquet':
+        # underscore prefix, so that dataset readers skip it
+        dataset, network_partition = parquet_dataset(job, options)
+        if network_partition:
+            return os.path.join(dataset, "_transforms", f"{network_partition}.json")
+        return os.path.join(dataset, "_transforms.json")
+    return job.out_fname.replace(".gpkg", f"__{job.layer}__transforms.json")
+
+
+def write_output_transforms(fname, transforms):
+    """Record the transforms that an output layer's cell_index_{i} columns refer to"""
+    records = [
+        {'crs': str(t.crs), 'width': t.width, 'height': t.height, 'transform': list(t.transform)}
+        for t in transforms
+    ]
+    with open(fname, 'w') as fh:
+        json.dump(records, fh)
+
+
+def read_output_transforms(fname):
+    """Read the transforms recorded for an output layer, as comparable tuples"""
+    with open(fname) as fh:
+        records = json.load(fh)
+    return [(r['crs'], r['width'], r['height'], tuple(r['transform'])) for r in records]
+
+
+def map_transform_ids(hazards, transforms, output_transforms):
+    """Renumber hazards' transform ids to match an output's cell_index_{i} columns
+
+    Returns None if a hazard is on a grid the output has no cell indices for.
+    """
+    output_ids = {}
+    for transform_id in hazards.transform_id.unique():
+        t = transforms[transform_id]
+        key = (str(t.crs), t.width, t.height, tuple(t.transform))
+        if key not in output_transforms:
+            logging.info("No cell indices for transform %s", transform_id)
+            return None
+        output_ids[transform_id] = output_transforms.index(key)
+    hazards = hazards.copy()
+    hazards['transform_id'] = hazards.transform_id.map(output_ids)
+    return hazards
+
+
+def index_columns(hazards):
+    return [f'cell_index_{i}_{xy}' for i in sorted(hazards.transform_id.unique()) for xy in ('x', 'y')]
+
+
+def append_hazards(job, transforms, hazard_transforms, data_path, options=Options(), lock=nullcontext()):
+    """Add hazard columns missing from an existing output layer, in place
+
+    Hazard values are looked up using the cell_index_{i}_x/_y columns
+    already stored in the output. Returns False, leaving the output
+    untouched, if a missing hazard is on a grid that the output has no cell
+    indices for.
+    """
+    try:
+        output_transforms = read_output_transforms(output_transforms_fname(job, options))
+    except FileNotFoundError:
+        logging.info("No transforms recorded for %s %s", os.path.basename(job.out_fname), job.layer)
+        return False
+
+    if options.output_format == 'parquet':
+        return append_hazards_parquet(job, transforms, hazard_transforms, output_transforms, data_path, options)
+
+    columns = set(pyogrio.read_info(job.out_fname, layer=job.layer)['fields'])
+    missing = hazard_transforms[~hazard_transforms.key.isin(columns)]
+    if missing.empty:
+        logging.info("No hazards to add to %s %s", os.path.basename(job.out_fname), job.layer)
+        return True
+
+    # map current transform ids to the numbering used in the output
+    missing = map_transform_ids(missing, transforms, output_transforms)
+    if missing is None or not columns.issuperset(index_columns(missing)):
+        logging.info("No cell indices for new hazards in %s %s", os.path.basename(job.out_fname), job.layer)
+        return False
+
+    logging.info("Adding %s to %s %s", list(missing.key), os.path.basename(job.out_fname), job.layer)
+    df = geopandas.read_file(
+        job.out_fname, layer=job.layer, columns=index_columns(missing), ignore_geometry=True,
+        fid_as_index=True)
+    associate_hazards(df, missing, data_path, options.read_mode, options.cube_dir)
+
+    with lock:
+        add_gpkg_columns(job.out_fname, job.layer, df[list(missing.key)])
+    return True
+
+
+def append_hazards_parquet(job, transforms, hazard_transforms, output_transforms, data_path, options=Options()):
+    """Add missing hazard columns to each part file of a GeoParquet output"""
+    dataset, network_partition = parquet_dataset(job, options)
+    if 'transform' in options.partition_by:
+        part_dir = parquet_part_dir(dataset, network_partition, "*")
+    else:
+        part_dir = parquet_part_dir(dataset, network_partition)
+    parts = sorted(glob.glob(os.path.join(part_dir, "part-*.parquet")))
+
+    # check every part can be updated before changing any
+    updates = []
+    for part in parts:
+        columns = set(pyarrow.parquet.read_schema(part).names)
+        missing = hazard_transforms[~hazard_transforms.key.isin(columns)]
+        missing = map_transform_ids(missing, transforms, output_transforms)
+        if missing is None:
+            return False
+        partition = re.search(r'transform_id=(\d+)', os.path.relpath(part, dataset))
+        if partition is not None:
+            missing = missing[missing.transform_id == int(partition.group(1))]
+        if missing.empty:
+            continue
+        if not columns.issuperset(index_columns(missing)):
+            logging.info("No cell indices for new hazards in %s", part)
+            return False
+        updates.append((part, missing))
+
+    if not updates:
+        logging.info("No hazards to add to %s", part_dir)
+    for part, missing in updates:
+        logging.info("Adding %s to %s", list(missing.key), part)
+        df = geopandas.read_parquet(part)
+        associate_hazards(df, missing, data_path, options.read_mode, options.cube_dir)
+        # write then rename, so an interrupted write never leaves a partial file
+        tmp_fname = f"{part}.{os.getpid()}.tmp"
+        write_parquet(df, tmp_fname, options)
+        os.replace(tmp_fname, part)
+    return True
+
+
+def add_gpkg_columns(fname, layer, values):
+    """Add columns to a GPKG layer in place, matching rows by fid (values.index)
+
+    Runs as a single transaction, so the layer is unchanged if anything fails.
+    """
+    connection = sqlite3.connect(fname, isolation_level=None)
+    # GDAL's rtree triggers on the layer refer to spatial functions, which
+    # must exist for UPDATE to run. They only fire when fid or geometry
+    # change, so they are never called here.
+    for name in ('ST_IsEmpty', 'ST_MinX', 'ST_MaxX', 'ST_MinY', 'ST_MaxY'):
+        connection.create_function(name, 1, _unavailable_spatial_function)
+    try:
+        connection.execute('BEGIN')
+        for key, column in values.items():
+            quoted = '"{}"'.format(key.replace('"', '""'))
+            sql_type = 'INTEGER' if pandas.api.types.is_integer_dtype(column) else 'REAL'
+            connection.execute(f'ALTER TABLE "{layer}" ADD COLUMN {quoted} {sql_type}')
+            connection.executemany(
+                f'UPDATE "{layer}" SET {quoted} = ? WHERE fid = ?',
+                zip(column.tolist(), column.index.tolist()))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+
+
+def _unavailable_spatial_function(geom):
+    raise NotImplementedError("Spatial SQL functions are not available outside GDAL")
+
+
+def join_attributes(df, splits):
+    """Join attributes of the parent rows in df onto split pieces"""
+    attrs = pandas.DataFrame(df.drop(columns=df.geometry.name))
+    attrs = attrs.take(splits['parent'].values).reset_index(drop=True)
+    pieces = splits.drop(columns='parent').reset_index(drop=True)
+    return geopandas.GeoDataFrame(
+        pandas.concat([attrs, pieces], axis=1), geometry=splits.geometry.name, crs=splits.crs)
 
 
-def associate_raster(df, key, fname, cell_index_col='cell_index', band_number=1):
-    with rasterio.open(fname) as dataset:
+def take_splits(df, splits, crs):
+    """Repeat the rows of df for each split piece, with the pieces as geometry"""
+    attrs = pandas.DataFrame(df.drop(columns=df.geometry.name))
+    attrs = attrs.take(splits.parent).reset_index(drop=True)
+    return geopandas.GeoDataFrame(attrs, geometry=splits.geometry, crs=crs)
+
+
+def associate_rasters(df, hazards, data_path, cell_index_col='cell_index', band_number=1,
+                      read_mode='window', cube_dir=None):
+    """Associate values from several rasters on the same grid
+
+    Reads cell indices from the integer {cell_index_col}_x/_y columns, then
+    gathers each raster's values for all rows at once with numpy fancy
+    indexing.
+    """
+    x = df[f'{cell_index_col}_x'].to_numpy()
+    y = df[f'{cell_index_col}_y'].to_numpy()
+    for key, values, _ in read_rasters(hazards, x, y, data_path, band_number, read_mode, cube_dir):
+        df[key] = values
+
+
+def associate_hazards(df, hazard_transforms, data_path, read_mode='window', cube_dir=None):
+    """Associate all hazard values, one batch per transform"""
+    with instrumentation.stage("associate hazards", rows_in=len(df)):
+        for transform_id, hazards in hazard_transforms.groupby('transform_id', sort=False):
+            logging.info("Hazards %s transform %s", list(hazards.key), transform_id)
+            cell_index_col = f'cell_index_{transform_id}'
+            associate_rasters(df, hazards, data_path, cell_index_col, read_mode=read_mode, cube_dir=cube_dir)
+
+
+def read_rasters(hazards, x, y, data_path, band_number=1, read_mode='window', cube_dir=None):
+    """Read values of several rasters on the same grid at cell indices
+
+    Yields (key, values, nodata) for each hazard, reading from the hazard
+    cube for the grid if read_mode is "cube".
+    """
+    if read_mode == 'cube':
+        yield from read_cube(hazards, x, y, cube_dir)
+        return
+    for hazard in hazards.itertuples():
+        with rasterio.open(os.path.join(data_path, hazard.path)) as dataset:
+            yield hazard.key, read_values(dataset, x, y, band_number, read_mode), dataset.nodata
+
+
+def read_values(dataset, x, y, band_number=1, read_mode='window'):
+    """Read raster values at cell indices x (columns) and y (rows)
+
+    read_mode is one of:
+    - "full": read the whole band
+    - "window": read only the bounding window of the cell indices
+    - "blocks": read only the internal raster blocks touched by the cell indices
+    """
+    if len(x) == 0:
+        return numpy.empty(0, dtype=dataset.dtypes[band_number - 1])
+
+    if read_mode == 'full':
         band_data = dataset.read(band_number)
-        df[key] = df[cell_index_col].apply(lambda i: band_data[i[1], i[0]])
+        return band_data[y, x]
+
+    if read_mode == 'window':
+        col_off = x.min()
+        row_off = y.min()
+        window = Window(col_off, row_off, x.max() - col_off + 1, y.max() - row_off + 1)
+        band_data = dataset.read(band_number, window=window)
+        return band_data[y - row_off, x - col_off]
+
+    if read_mode == 'blocks':
+        block_height, block_width = dataset.block_shapes[band_number - 1]
+        block_rows = y // block_height
+        block_cols = x // block_width
+        block_ids = block_rows * (dataset.width // block_width + 1) + block_cols
+        values = numpy.empty(len(x), dtype=dataset.dtypes[band_number - 1])
+        # visit each touched block once
+        order = numpy.argsort(block_ids, kind='stable')
+        _, starts = numpy.unique(block_ids[order], return_index=True)
+        for rows in numpy.split(order, starts[1:]):
+            window = dataset.block_window(band_number, block_rows[rows[0]], block_cols[rows[0]])
+            block_data = dataset.read(band_number, window=window)
+            values[rows] = block_data[y[rows] - window.row_off, x[rows] - window.col_off]
+        return values
+
+    raise ValueError(f"Unknown read_mode: {read_mode}")
+
+
+def build_hazard_cubes(hazard_transforms, data_path, cube_dir):
+    """Stack the hazards on each grid into a memory-mapped array
+
+    Each cube is a .npy array of (row, column, hazard), with a JSON index of
+    hazard keys, dtypes, nodata values and source files. Pixel-interleaved,
+    all hazard values for a cell are stored together, so reading every
+    hazard at a feature's cell touches one page rather than one per hazard.
+    Cubes are rebuilt if they do not contain all of the hazards on a grid,
+    or if a source file has changed.
+    """
+    if cube_dir is None:
+        raise ValueError("read_mode 'cube' needs cube_dir")
+    os.makedirs(cube_dir, exist_ok=True)
+    for transform_id, hazards in hazard_transforms.groupby('transform_id', sort=False):
+        cube_fname = hazard_cube_fname(cube_dir, hazards.iloc[0])
+        sources = [hazard_source(hazard, data_path) for hazard in hazards.itertuples()]
+        index = read_cube_index(cube_fname)
+        if index is not None and all(source in index['sources'] for source in sources):
+            logging.info("Hazard cube for transform %s is up to date: %s", transform_id, cube_fname)
+            continue
+
+        logging.info("Building hazard cube for transform %s: %s", transform_id, cube_fname)
+        dtypes, nodata = [], []
+        for hazard in hazards.itertuples():
+            with rasterio.open(os.path.join(data_path, hazard.path)) as dataset:
+                dtypes.append(dataset.dtypes[0])
+                nodata.append(dataset.nodata)
+        grid = hazards.iloc[0]
+        tmp_fname = f"{cube_fname}.{os.getpid()}.tmp.npy"
+        cube = numpy.lib.format.open_memmap(
+            tmp_fname, mode='w+', dtype=numpy.result_type(*dtypes),
+            shape=(int(grid.height), int(grid.width), len(hazards)))
+        for band, hazard in enumerate(tqdm(list(hazards.itertuples()))):
+            with rasterio.open(os.path.join(data_path, hazard.path)) as dataset:
+                for _, window in dataset.block_windows(1):
+                    rows, cols = window.toslices()
+                    cube[rows, cols, band] = dataset.read(1, window=window)
+        cube.flush()
+        del cube
+
+        # write then rename, so an interrupted build never leaves a partial cube
+        if index is not None:
+            os.remove(f"{cube_fname}.json")
+        os.replace(tmp_fname, f"{cube_fname}.npy")
+        with open(f"{cube_fname}.json", 'w') as fh:
+            json.dump({'keys': list(hazards.key), 'dtypes': dtypes, 'nodata': nodata, 'sources': sources}, fh)
+
+
+def hazard_cube_fname(cube_dir, hazard):
+    """Hazard cube file name, without extension, for the grid of a hazard_transforms row"""
+    grid = (hazard.crs, hazard.width, hazard.height, tuple(hazard[f'transform_{i}'] for i in range(6)))
+    return os.path.join(cube_dir, hashlib.sha256(repr(grid).encode()).hexdigest())
+
+
+def hazard_source(hazard, data_path):
+    """Key, path, size and modification time of a hazard's source file"""
+    stat = os.stat(os.path.join(data_path, hazard.path))
+    return {'key': hazard.key, 'path': hazard.path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def read_cube_index(cube_fname):
+    try:
+        with open(f"{cube_fname}.json") as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def read_cube(hazards, x, y, cube_dir):
+    """Read values of several hazards on the same grid from its hazard cube
+
+    Yields (key, values, nodata) for each hazard, gathering all hazards at
+    once from the memory-mapped cube.
+    """
+    if cube_dir is None:
+        raise ValueError("read_mode 'cube' needs cube_dir")
+    cube_fname = hazard_cube_fname(cube_dir, hazards.iloc[0])
+    index = read_cube_index(cube_fname)
+    if index is None:
+        raise FileNotFoundError(f"No hazard cube, see build_hazard_cubes: {cube_fname}")
+    cube = numpy.load(f"{cube_fname}.npy", mmap_mode='r')
+    bands = [index['keys'].index(key) for key in hazards.key]
+    values = cube[y[:, numpy.newaxis], x[:, numpy.newaxis], bands]
+    for i, band in enumerate(bands):
+        yield index['keys'][band], values[:, i].astype(index['dtypes'][band]), index['nodata'][band]
 
 
 def read_transforms(hazards, data_path):
@@ -143,129 +829,319 @@ def read_transforms(hazards, data_path):
     return hazard_transforms, transforms
 
 
-def process_nodes(nodes, transforms, hazard_transforms, data_path):
-    # lookup per transform
+def process_nodes(nodes, transforms, hazard_transforms, data_path, options=Options()):
+    """Look up cell indices and associate hazard values for nodes
+
+    Returns a copy of nodes with added columns, leaving nodes unchanged.
+    """
+    nodes = nodes.copy(deep=False)
+    x, y = get_midpoints(nodes.geometry)
+
+    # lookup per transform, reprojecting coordinates once per distinct CRS
+    coords = {}
     for i, t in enumerate(transforms):
-        # transform to grid
-        crs_df = nodes.to_crs(t.crs)
+        crs_key = str(t.crs)
+        if crs_key not in coords:
+            coords[crs_key] = transform_coordinates(x, y, nodes.crs, t.crs)
         # save cell index for fast lookup of raster values
-        crs_df[f'cell_index_{i}'] = crs_df.geometry.progress_apply(lambda geom: get_indices(geom, t))
-        # transform back
-        nodes = crs_df.to_crs(nodes.crs)
+        nodes[f'cell_index_{i}_x'], nodes[f'cell_index_{i}_y'] = get_indices_array(*coords[crs_key], t)
 
     # associate hazard values
-    for hazard in hazard_transforms.itertuples():
-        logging.info("Hazard %s transform %s", hazard.key, hazard.transform_id)
-        fname = os.path.join(data_path, hazard.path)
-        cell_index_col = f'cell_index_{hazard.transform_id}'
-        associate_raster(nodes, hazard.key, fname, cell_index_col)
-
-    # split and drop tuple columns so GPKG can save
-    for i, t in enumerate(transforms):
-        nodes = split_index_column(nodes, f'cell_index_{i}')
-        nodes.drop(columns=f'cell_index_{i}', inplace=True)
+    associate_hazards(nodes, hazard_transforms, data_path, options.read_mode, options.cube_dir)
     return nodes
 
 
-def try_merge(geom):
-    if geom.geom_type =='MultiLineString':
-        geom = linemerge(geom)
-    return geom
+def try_merge(geoms):
+    """Merge the parts of each MultiLineString where they join up"""
+    geoms = numpy.array(geoms, dtype=object)
+    multi = shapely.get_type_id(geoms) == shapely.GeometryType.MULTILINESTRING
+    geoms[multi] = shapely.line_merge(geoms[multi])
+    return geoms
 
 
-def process_edges(edges, transforms, hazard_transforms, data_path):
+def process_edges(edges, transforms, hazard_transforms, data_path, options=Options(), cache_key=None):
+    """Split edges on each transform's grid and associate hazard values
+
+    Returns split pieces with a 'parent' column of row positions in edges,
+    cell indices and hazard values, but without edge attributes: use
+    join_attributes to add them.
+    """
     # handle multilinestrings
-    edges.geometry = edges.geometry.apply(try_merge)
-    geom_types = edges.geometry.apply(lambda g: g.geom_type)
-    logging.info(geom_types.value_counts())
-    edges = explode_multi(edges)
+    geoms = try_merge(edges.geometry.values)
+    logging.info(geopandas.GeoSeries(geoms).geom_type.value_counts())
+    parent, geoms = explode_geometries(geoms)
+    splits = geopandas.GeoDataFrame({'parent': parent}, geometry=geoms, crs=edges.crs)
 
     # split edges per transform
-    for i, t in enumerate(transforms):
+    splits = split_on_transforms(
+        splits, transforms,
+        lambda df, t: split_df(df, t, options.split_processes, options.split_chunksize),
+        options.cache_dir, cache_key)
+
+    # associate hazard values
+    associate_hazards(splits, hazard_transforms, data_path, options.read_mode, options.cube_dir)
+
+    return splits
+
+
+def split_on_transforms(splits, transforms, split, cache_dir=None, cache_key=None):
+    """Split pieces on each transform's grid in turn, saving cell indices
+
+    split is called as split(df, t) and must return Splits. If cache_key is
+    given, the pieces after each transform are cached in cache_dir, and
+    splitting resumes after the longest prefix of transforms found there.
+    """
+    crs = splits.crs
+    start = 0
+    if cache_key is not None:
+        for n in range(len(transforms), 0, -1):
+            cache_fname = split_cache_fname(cache_dir, cache_key, transforms[:n])
+            if os.path.exists(cache_fname):
+                logging.info("Reading cached splits %s", cache_fname)
+                splits = geopandas.read_parquet(cache_fname)
+                start = n
+                break
+
+    for i, t in enumerate(transforms[start:], start=start):
         # transform to grid
-        crs_df = edges.to_crs(t.crs)
-        crs_df = split_df(crs_df, t)
+        crs_df = splits.to_crs(t.crs)
+        with instrumentation.stage("split", rows_in=len(crs_df), transform=i) as record:
+            crs_df = take_splits(crs_df, split(crs_df, t), t.crs)
+            record['rows_out'] = len(crs_df)
         # save cell index for fast lookup of raster values
-        crs_df[f'cell_index_{i}'] = crs_df.geometry.progress_apply(lambda geom: get_indices(geom, t))
+        crs_df[f'cell_index_{i}_x'], crs_df[f'cell_index_{i}_y'] = get_indices_array(
+            *get_midpoints(crs_df.geometry), t)
         # transform back
-        edges = crs_df.to_crs(edges.crs)
+        splits = crs_df.to_crs(crs)
+        if cache_key is not None:
+            write_split_cache(splits, split_cache_fname(cache_dir, cache_key, transforms[:i + 1]))
 
-    # associate hazard values
-    for hazard in hazard_transforms.itertuples():
-        logging.info("Hazard %s transform %s", hazard.key, hazard.transform_id)
-        fname = os.path.join(data_path, hazard.path)
-        cell_index_col = f'cell_index_{hazard.transform_id}'
-        associate_raster(edges, hazard.key, fname, cell_index_col)
+    return splits
 
-    # split and drop tuple columns so GPKG can save
-    for i, t in enumerate(transforms):
-        edges = split_index_column(edges, f'cell_index_{i}')
-        edges.drop(columns=f'cell_index_{i}', inplace=True)
 
-    return edges
+def hash_file(fname, blocksize=2**20):
+    """SHA-256 hex digest of a file's contents"""
+    file_hash = hashlib.sha256()
+    with open(fname, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
 
 
-def split_df(df, t):
-    # split
-    core_splits = []
-    for edge in tqdm(df.itertuples(), total=len(df)):
-        # split edge
+def split_cache_fname(cache_dir, cache_key, transforms):
+    """Cache file name for pieces split on each of transforms in turn"""
+    key_hash = hashlib.sha256(cache_key.encode())
+    for t in transforms:
+        key_hash.update(repr((str(t.crs), t.width, t.height, tuple(t.transform))).encode())
+    return os.path.join(cache_dir, f"{key_hash.hexdigest()}.parquet")
+
+
+def write_split_cache(splits, cache_fname):
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    # write then rename, so an interrupted write never leaves a partial cache file
+    tmp_fname = f"{cache_fname}.{os.getpid()}.tmp"
+    splits.to_parquet(tmp_fname)
+    os.replace(tmp_fname, cache_fname)
+
+
+def split_df(df, t, processes=1, chunksize=10000):
+    """Split lines on a grid, in chunks over a process pool if processes > 1
+
+    Workers receive only geometries and return only split pieces with the
+    position of their parent row, so attributes never cross processes.
+    """
+    geoms = numpy.asarray(df.geometry.values)
+    chunks = [(start, geoms[start:start + chunksize]) for start in range(0, len(geoms), chunksize)]
+    if processes == 1:
+        results = [split_lines(chunk, t, start) for start, chunk in tqdm(chunks)]
+    else:
+        with ProcessPoolExecutor(processes, initializer=init_split_worker, initargs=(t,)) as executor:
+            # map returns results in chunk order
+            results = list(tqdm(executor.map(split_lines_worker, chunks), total=len(chunks)))
+
+    parent = numpy.concatenate([r[0] for r in results] + [numpy.empty(0, dtype=numpy.int64)])
+    pieces = [piece for r in results for piece in r[1]]
+    logging.info(f"Split {len(df)} edges into {len(pieces)} pieces")
+    return Splits(parent, geometry_array(pieces))
+
+
+def split_lines(geoms, t, offset=0):
+    """Split lines on a grid, returning parent index and split pieces"""
+    parent = []
+    pieces = []
+    for i, geom in enumerate(geoms, start=offset):
         splits = split_linestring(
-            edge.geometry,
+            geom,
             t.width,
             t.height,
             t.transform
         )
-        # add to collection
-        for s in splits:
-            s_dict = edge._asdict()
-            del s_dict['Index']
-            s_dict['geometry'] = s
-            core_splits.append(s_dict)
-    logging.info(f"Split {len(df)} edges into {len(core_splits)} pieces")
-    sdf = geopandas.GeoDataFrame(core_splits, crs=t.crs, geometry='geometry')
-    return sdf
+        parent.extend([i] * len(splits))
+        pieces.extend(splits)
+    return numpy.array(parent, dtype=numpy.int64), pieces
+
+
+# Transform used by split workers, set once per worker by init_split_worker
+_split_transform = None
+
+
+def init_split_worker(t):
+    global _split_transform
+    _split_transform = t
 
 
-def process_areas(areas, transforms, hazard_transforms, data_path):
+def split_lines_worker(chunk):
+    start, geoms = chunk
+    return split_lines(geoms, _split_transform, start)
+
+
+def process_areas(areas, transforms, hazard_transforms, data_path, options=Options(), cache_key=None):
+    """Split areas on each transform's grid and associate hazard values
+
+    Returns split pieces with a 'parent' column of row positions in areas,
+    as for process_edges.
+    """
+    parent, geoms = explode_geometries(areas.geometry.values)
+    splits = geopandas.GeoDataFrame({'parent': parent}, geometry=geoms, crs=areas.crs)
+
     # split areas per transform
-    for i, t in enumerate(transforms):
-        # transform to grid
-        crs_df = areas.to_crs(t.crs)
-        crs_df = split_area_df(crs_df, t)
-        # save cell index for fast lookup of raster values
-        crs_df[f'cell_index_{i}'] = crs_df.geometry.progress_apply(lambda geom: get_indices(geom, t))
-        # transform back
-        areas = crs_df.to_crs(areas.crs)
+    splits = split_on_transforms(splits, transforms, split_area_df, options.cache_dir, cache_key)
 
     # associate hazard values
-    for hazard in hazard_transforms.itertuples():
-        logging.info("Hazard %s transform %s", hazard.key, hazard.transform_id)
-        fname = os.path.join(data_path, hazard.path)
-        cell_index_col = f'cell_index_{hazard.transform_id}'
-        associate_raster(areas, hazard.key, fname, cell_index_col)
+    associate_hazards(splits, hazard_transforms, data_path, options.read_mode, options.cube_dir)
+
+    return splits
+
+
+def process_area_coverage(areas, transforms, hazard_transforms, data_path, options=Options()):
+    """Summarise hazard values over the grid cells each area covers
 
-    # split and drop tuple columns so GPKG can save
+    An alternative to process_areas which does not split areas into pieces.
+    For each hazard, adds the coverage-weighted mean ({key}_mean) and the
+    maximum ({key}_max) of values in cells touched by each area, ignoring
+    nodata. Returns a copy of areas with added columns.
+    """
+    areas = areas.copy(deep=False)
     for i, t in enumerate(transforms):
-        areas = split_index_column(areas, f'cell_index_{i}')
-        areas.drop(columns=f'cell_index_{i}', inplace=True)
+        geoms = numpy.asarray(areas.geometry.to_crs(t.crs).values)
+        coverage = get_coverage(geoms, t)
+        logging.info(f"  {len(areas)} areas cover {len(coverage.parent)} cells of transform {i}")
+
+        hazards = hazard_transforms[hazard_transforms.transform_id == i]
+        hazard_values = read_rasters(
+            hazards, coverage.col, coverage.row, data_path, read_mode=options.read_mode,
+            cube_dir=options.cube_dir)
+        for key, values, nodata in hazard_values:
+            values = values.astype(numpy.float64)
+            valid = numpy.isfinite(values)
+            if nodata is not None:
+                valid &= values != nodata
+            mean, max_ = coverage_stats(
+                coverage.parent[valid], coverage.fraction[valid], values[valid], len(areas))
+            areas[f'{key}_mean'] = mean
+            areas[f'{key}_max'] = max_
 
     return areas
 
+
+def get_coverage(geoms, t):
+    """Find the cells each geometry touches and the fraction of each cell covered
+
+    Requires a north-up grid. Cells outside the grid are ignored.
+    """
+    a, b, c, d, e, f = t.transform[:6]
+    if b != 0 or d != 0:
+        raise ValueError("Coverage needs a grid without rotation")
+    inverse = ~Affine(*t.transform[:6])
+    cell_area = abs(a * e)
+
+    parent = []
+    cols = []
+    rows = []
+    fractions = []
+    for i, geom in enumerate(tqdm(geoms)):
+        if geom is None or geom.is_empty:
+            continue
+        # range of cells in the geometry's bounding box
+        minx, miny, maxx, maxy = geom.bounds
+        col_a, row_a = inverse * (minx, miny)
+        col_b, row_b = inverse * (maxx, maxy)
+        col_min = max(math.floor(min(col_a, col_b)), 0)
+        col_max = min(math.floor(max(col_a, col_b)), t.width - 1)
+        row_min = max(math.floor(min(row_a, row_b)), 0)
+        row_max = min(math.floor(max(row_a, row_b)), t.height - 1)
+        if col_min > col_max or row_min > row_max:
+            continue
+        col, row = numpy.meshgrid(
+            numpy.arange(col_min, col_max + 1), numpy.arange(row_min, row_max + 1))
+        col = col.ravel()
+        row = row.ravel()
+
+        # cells fully inside count whole, only edge cells need an intersection
+        x0 = c + col * a
+        y0 = f + row * e
+        boxes = shapely.box(
+            numpy.minimum(x0, x0 + a), numpy.minimum(y0, y0 + e),
+            numpy.maximum(x0, x0 + a), numpy.maximum(y0, y0 + e))
+        shapely.prepare(geom)
+        inside = shapely.contains_properly(geom, boxes)
+        fraction = inside.astype(numpy.float64)
+        edge = ~inside & shapely.intersects(geom, boxes)
+        fraction[edge] = shapely.area(shapely.intersection(boxes[edge], geom)) / cell_area
+        keep = fraction > 0
+
+        parent.append(numpy.full(keep.sum(), i, dtype=numpy.int64))
+        cols.append(col[keep])
+        rows.append(row[keep])
+        fractions.append(fraction[keep])
+
+    if not parent:
+        empty = numpy.empty(0, dtype=numpy.int64)
+        return Coverage(empty, empty, empty, numpy.empty(0, dtype=numpy.float64))
+    return Coverage(
+        numpy.concatenate(parent), numpy.concatenate(cols), numpy.concatenate(rows),
+        numpy.concatenate(fractions))
+
+
+def coverage_stats(parent, fraction, values, n):
+    """Coverage-weighted mean and maximum of cell values for each of n parents"""
+    weight = numpy.bincount(parent, weights=fraction, minlength=n)
+    weighted_sum = numpy.bincount(parent, weights=fraction * values, minlength=n)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.where(weight > 0, weighted_sum / weight, numpy.nan)
+    max_ = numpy.full(n, numpy.nan)
+    numpy.fmax.at(max_, parent, values)
+    return mean, max_
+
+
 def explode_multi(df):
-    items = []
-    geoms = []
-    for item in df.itertuples(index=False):
-        if item.geometry.geom_type in ('MultiPoint', 'MultiLineString', 'MultiPolygon'):
-            for part in item.geometry:
-                items.append(item._asdict())
-                geoms.append(part)
-        else:
-            items.append(item._asdict())
-            geoms.append(item.geometry)
+    """Split multi-part geometries into one row per part"""
+    parent, geoms = explode_geometries(df.geometry.values)
+    attrs = pandas.DataFrame(df.drop(columns=df.geometry.name)).take(parent).reset_index(drop=True)
+    return geopandas.GeoDataFrame(attrs, geometry=geoms, crs=df.crs)
 
-    df = geopandas.GeoDataFrame(items, crs=df.crs, geometry=geoms)
-    return df
+
+def explode_geometries(geoms):
+    """Split multi-part geometries into parts, returning the position of each
+    part's parent geometry and the parts, in order
+
+    Other geometries, including GeometryCollections, are kept as they are.
+    """
+    geoms = numpy.asarray(geoms, dtype=object)
+    multi = numpy.isin(shapely.get_type_id(geoms), [
+        shapely.GeometryType.MULTIPOINT,
+        shapely.GeometryType.MULTILINESTRING,
+        shapely.GeometryType.MULTIPOLYGON,
+    ])
+    counts = numpy.ones(len(geoms), dtype=numpy.int64)
+    counts[multi] = shapely.get_num_geometries(geoms[multi])
+    parent = numpy.repeat(numpy.arange(len(geoms)), counts)
+
+    parts = numpy.empty(len(parent), dtype=object)
+    from_multi = multi[parent]
+    parts[~from_multi] = geoms[~multi]
+    parts[from_multi] = shapely.get_parts(geoms[multi])
+    return parent, parts
 
 
 def set_precision(geom, precision):
@@ -277,12 +1153,13 @@ def set_precision(geom, precision):
 
 
 def split_area_df(df, t):
-    # split
-    core_splits = []
-    for area in tqdm(df.itertuples(), total=len(df)):
+    """Split areas on a grid, returning parent row positions and split pieces"""
+    parent = []
+    pieces = []
+    for i, geom in enumerate(tqdm(df.geometry.values)):
         # split area
         splits = split_polygon(
-            area.geometry,
+            geom,
             t.width,
             t.height,
             t.transform
@@ -292,34 +1169,45 @@ def split_area_df(df, t):
         # to polygons
         splits = list(polygonize(splits))
         # add to collection
-        for s in splits:
-            s_dict = area._asdict()
-            del s_dict['Index']
-            s_dict['geometry'] = s
-            core_splits.append(s_dict)
-    logging.info(f"  Split {len(df)} areas into {len(core_splits)} pieces")
-    sdf = geopandas.GeoDataFrame(core_splits)
-    sdf.crs = t.crs
-    return sdf
-
-
-def get_indices(geom, t):
-    x, y = get_cell_indices(
-        geom,
-        t.width,
-        t.height,
-        t.transform)
-    # wrap around to handle edge cases
-    x = x % t.width
-    y = y % t.height
-    return (x, y)
+        parent.extend([i] * len(splits))
+        pieces.extend(splits)
+    logging.info(f"  Split {len(df)} areas into {len(pieces)} pieces")
+    return Splits(numpy.array(parent, dtype=numpy.int64), geometry_array(pieces))
+
+
+def geometry_array(geoms):
+    """Pack a list of geometries into a numpy object array"""
+    arr = numpy.empty(len(geoms), dtype=object)
+    arr[:] = geoms
+    return arr
 
 
-def split_index_column(df, prefix):
-    df[f'{prefix}_x'] = df[prefix].apply(lambda i: i[0])
-    df[f'{prefix}_y'] = df[prefix].apply(lambda i: i[1])
-    print("split_index_column_done")
-    return df
+def get_midpoints(geoms):
+    """Midpoints of geometry bounds, the point snail uses to find a geometry's cell"""
+    bounds = shapely.bounds(numpy.asarray(geoms.values))
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    return x, y
+
+
+def transform_coordinates(x, y, from_crs, to_crs):
+    """Reproject coordinate arrays"""
+    from_crs = pyproj.CRS.from_user_input(from_crs)
+    to_crs = pyproj.CRS.from_user_input(to_crs)
+    if from_crs == to_crs:
+        return x, y
+    transformer = pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+    return transformer.transform(x, y)
+
+
+def get_indices_array(x, y, t):
+    """Cell indices (column, row) of coordinate arrays, as int32 arrays"""
+    # apply the inverse affine transform, in the same form as snail
+    col, row = cell_coordinates(x, y, Affine(*t.transform[:6]))
+    # wrap around to handle edge cases
+    col = numpy.floor(col).astype(numpy.int64) % t.width
+    row = numpy.floor(row).astype(numpy.int64) % t.height
+    return col.astype(numpy.int32), row.astype(numpy.int32)
 
 
 if __name__ == '__main__':
@@ -338,17 +1226,30 @@ if __name__ == '__main__':
     data_path = os.path.join(base_path,'data')
     networks_csv = os.path.join(data_path, 'infrastructure', 'network_files.csv')
     hazards_csv = os.path.join(data_path, 'hazards', 'hazards.csv')
+    options = Options(
+        read_mode='window',
+        processes=1,
+        split_processes=1,
+        split_chunksize=10000,
+        write_batch_size=100000,
+        cache_dir=os.path.join(data_path, 'results', 'split_cache'),
+        incremental=False,
+        area_mode='split',
+        output_format='gpkg',
+        row_group_size=100000,
+        compression='zstd',
+        partition_by=(),
+        tile_cells=None,
+        cube_dir=os.path.join(data_path, 'hazards', 'cubes'),
+    )
 
     # Ignore writing-to-parquet warnings
     warnings.filterwarnings('ignore', message='.*initial implementation of Parquet.*')
     # Ignore reading-geopackage warnings
     warnings.filterwarnings('ignore', message='.*Sequential read of iterator was interrupted.*')
 
-    # Enable progress_apply
-    tqdm.pandas()
-
     # Enable info logging
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
     logging.info("Start.")
-    main(data_path, networks_csv, hazards_csv)
+    main(data_path, networks_csv, hazards_csv, options)
     logging.info("Done.")
\ No newline at end of file
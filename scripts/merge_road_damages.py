@@ -6,6 +6,8 @@ from pathlib import Path
 
 import pandas
 
+import instrumentation
+
 with open(Path(__file__).parent.parent / "config.json", "r") as fh:
     config = json.load(fh)
 base_path = Path(config["base_path"])
@@ -54,17 +56,22 @@ damage_columns = [
 ]
 for path in road_damage_paths:
     print(path)
-    df = pandas.read_csv(
-        base_path / path,
-        usecols=["fid"] + damage_columns,
-        dtype={col: "float64" for col in damage_columns},
-    )
+    with instrumentation.stage("read damages", path=path) as record:
+        df = pandas.read_csv(
+            base_path / path,
+            usecols=["fid"] + damage_columns,
+            dtype={col: "float64" for col in damage_columns},
+        )
+        record["rows_out"] = len(df)
     print("read", len(df))
-    df_damage = df[damage_columns]
-    mask = df_damage.max(axis=1) > 0
-    damaged = df[mask]
+    with instrumentation.stage("filter damaged", rows_in=len(df), path=path) as record:
+        df_damage = df[damage_columns]
+        mask = df_damage.max(axis=1) > 0
+        damaged = df[mask]
+        record["rows_out"] = len(damaged)
     print("filtered", len(damaged))
-    damaged.to_parquet(f"scratch/{(base_path / path).name}.pq")
+    with instrumentation.stage("write damaged", rows_in=len(damaged), path=path):
+        damaged.to_parquet(f"scratch/{(base_path / path).name}.pq")
     print("wrote")
 
     del damaged
@@ -78,19 +85,26 @@ tmp_damage_paths = [
     "scratch/road_khulna damage.csv.pq",
 ]
 dfs = []
-for path in tmp_damage_paths:
-    df = pandas.read_parquet(path)
-    dfs.append(df)
-    print("read", path)
-coastal_road_damages = pandas.concat(dfs)
-coastal_road_damages.to_parquet(
-    base_path
-    / "Bangladesh GCA-UNOPS data/Data/Output2/Coastal flood/Feature wise damage/road_coastal_merged damage.csv.pq"
-)
+with instrumentation.stage("merge damaged") as record:
+    for path in tmp_damage_paths:
+        df = pandas.read_parquet(path)
+        dfs.append(df)
+        print("read", path)
+    coastal_road_damages = pandas.concat(dfs)
+    record["rows_out"] = len(coastal_road_damages)
+with instrumentation.stage("write merged", rows_in=len(coastal_road_damages), format="parquet"):
+    coastal_road_damages.to_parquet(
+        base_path
+        / "Bangladesh GCA-UNOPS data/Data/Output2/Coastal flood/Feature wise damage/road_coastal_merged damage.csv.pq"
+    )
 print("wrote pq")
-coastal_road_damages.to_csv(
-    base_path
-    / "Bangladesh GCA-UNOPS data/Data/Output2/Coastal flood/Feature wise damage/road_coastal_merged damage.csv",
-    index=False,
-)
+with instrumentation.stage("write merged", rows_in=len(coastal_road_damages), format="csv"):
+    coastal_road_damages.to_csv(
+        base_path
+        / "Bangladesh GCA-UNOPS data/Data/Output2/Coastal flood/Feature wise damage/road_coastal_merged damage.csv",
+        index=False,
+    )
 print("wrote csv")
+
+instrumentation.write_report(instrumentation.report_fname("merge_road_damages", "scratch/run_reports"))
+
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Clip hazard rasters to Bangladesh and align them onto shared grids
+
+Reads a hazards CSV (key, path columns), writes a cloud-optimised GeoTIFF
+per hazard and a new hazards CSV pointing to them, for use with
+intersection-snail.py.
+
+Rasters with the same CRS and resolution are snapped onto one grid,
+covering the union of their clipped extents, so each set of compatible
+rasters becomes a single transform for the network splitting.
+"""
+import logging
+import math
+import os
+
+from collections import namedtuple
+
+import numpy
+import pandas
+import rasterio
+import rasterio.shutil
+
+from affine import Affine
+from rasterio.io import MemoryFile
+from rasterio.warp import Resampling, reproject, transform_bounds
+
+
+# Bangladesh extent, as in extract_landslide_opportunities.sh
+BGD_BOUNDS = (87.932274, 20.648357, 92.735326, 26.67918)
+BGD_CRS = "EPSG:4326"
+
+# Helper class to store a target grid
+Grid = namedtuple('Grid', ['crs', 'width', 'height', 'transform'])
+
+
+def main(data_path, hazards_csv, out_csv, out_dir, bounds=BGD_BOUNDS, bounds_crs=BGD_CRS):
+    hazards = pandas.read_csv(hazards_csv)
+
+    # group compatible rasters, keyed by CRS and resolution
+    groups = {}
+    for hazard in hazards.itertuples():
+        with rasterio.open(os.path.join(data_path, hazard.path)) as dataset:
+            groups.setdefault(grid_key(dataset), []).append(hazard.Index)
+    logging.info("%d hazards, %d grids", len(hazards), len(groups))
+
+    os.makedirs(out_dir, exist_ok=True)
+    out_paths = {}
+    for key, index in groups.items():
+        fnames = [os.path.join(data_path, path) for path in hazards.path[index]]
+        grid = target_grid(fnames, bounds, bounds_crs)
+        logging.info("Grid %s: %d x %d, %d hazards", key, grid.width, grid.height, len(index))
+        for i in index:
+            hazard = hazards.loc[i]
+            out_fname = os.path.join(out_dir, f"{hazard.key}.tif")
+            logging.info("Writing %s", out_fname)
+            write_cog(os.path.join(data_path, hazard.path), out_fname, grid)
+            out_paths[i] = os.path.relpath(out_fname, data_path)
+
+    hazards['path'] = pandas.Series(out_paths)
+    hazards.to_csv(out_csv, index=False)
+
+
+def grid_key(dataset):
+    """Rasters with the same key can share a grid: the same CRS and
+    resolution, without rotation
+
+    Rotated rasters are keyed by their full transform, so keep their own
+    grid.
+    """
+    t = dataset.transform
+    if t.b != 0 or t.d != 0:
+        return (str(dataset.crs), tuple(t))
+    return (str(dataset.crs), t.a, t.e)
+
+
+def target_grid(fnames, bounds, bounds_crs):
+    """Grid covering the union of the rasters' extents, clipped to bounds
+
+    The grid is aligned to the pixels of the first raster, so that raster
+    and any others aligned with it are copied without resampling.
+    """
+    with rasterio.open(fnames[0]) as dataset:
+        grid = Grid(dataset.crs, dataset.width, dataset.height, dataset.transform)
+    crs, t = grid.crs, grid.transform
+    if t.b != 0 or t.d != 0:
+        # rotated, keep the grid as it is
+        return grid
+
+    # union of the raster extents, in pixel coordinates of the first raster
+    col_min, row_min, col_max, row_max = math.inf, math.inf, -math.inf, -math.inf
+    for fname in fnames:
+        with rasterio.open(fname) as dataset:
+            left, bottom, right, top = dataset.bounds
+        cols, rows = ~t * (numpy.array([left, right]), numpy.array([top, bottom]))
+        col_min, col_max = min(col_min, cols.min()), max(col_max, cols.max())
+        row_min, row_max = min(row_min, rows.min()), max(row_max, rows.max())
+
+    # clip to bounds
+    left, bottom, right, top = transform_bounds(bounds_crs, crs, *bounds)
+    cols, rows = ~t * (numpy.array([left, right]), numpy.array([top, bottom]))
+    col_min, col_max = max(col_min, cols.min()), min(col_max, cols.max())
+    row_min, row_max = max(row_min, rows.min()), min(row_max, rows.max())
+
+    # snap outwards to whole pixels, allowing for floating point error
+    col_min, row_min = math.floor(col_min + 1e-6), math.floor(row_min + 1e-6)
+    col_max, row_max = math.ceil(col_max - 1e-6), math.ceil(row_max - 1e-6)
+    if col_max <= col_min or row_max <= row_min:
+        raise ValueError(f"Rasters do not overlap bounds: {fnames}")
+
+    transform = t * Affine.translation(col_min, row_min)
+    return Grid(crs, int(col_max - col_min), int(row_max - row_min), transform)
+
+
+def write_cog(fname, out_fname, grid, blocksize=512, compress='deflate'):
+    """Write a raster on a grid, as a tiled, compressed GeoTIFF with overviews
+
+    Pixels are copied with nearest neighbour resampling, which is exact for
+    rasters aligned with the grid.
+    """
+    with rasterio.open(fname) as src:
+        nodata = src.nodata
+        if nodata is None and numpy.issubdtype(numpy.dtype(src.dtypes[0]), numpy.floating):
+            nodata = numpy.nan
+        data = numpy.full(
+            (src.count, grid.height, grid.width), 0 if nodata is None else nodata, dtype=src.dtypes[0])
+        reproject(
+            source=rasterio.band(src, list(range(1, src.count + 1))),
+            destination=data,
+            dst_transform=grid.transform,
+            dst_crs=grid.crs,
+            dst_nodata=nodata,
+            resampling=Resampling.nearest,
+        )
+        profile = {
+            'driver': 'GTiff',
+            'count': src.count,
+            'dtype': src.dtypes[0],
+            'crs': grid.crs,
+            'transform': grid.transform,
+            'width': grid.width,
+            'height': grid.height,
+            'nodata': nodata,
+        }
+
+    # the COG driver only creates copies, so write to memory first
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dataset:
+            dataset.write(data)
+        with memfile.open() as dataset:
+            predictor = 3 if numpy.issubdtype(data.dtype, numpy.floating) else 2
+            rasterio.shutil.copy(
+                dataset, out_fname, driver='COG', BLOCKSIZE=blocksize, COMPRESS=compress,
+                PREDICTOR=predictor, OVERVIEWS='AUTO', OVERVIEW_RESAMPLING='NEAREST',
+                BIGTIFF='IF_SAFER')
+
+
+if __name__ == '__main__':
+    base_path = os.path.join('D:/Bangladesh')
+    data_path = os.path.join(base_path, 'data')
+    hazards_csv = os.path.join(data_path, 'hazards', 'hazards.csv')
+    out_csv = os.path.join(data_path, 'hazards', 'hazards_preprocessed.csv')
+    out_dir = os.path.join(data_path, 'hazards', 'preprocessed')
+
+    # Enable info logging
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    logging.info("Start.")
+    main(data_path, hazards_csv, out_csv, out_dir)
+    logging.info("Done.")